@@ -0,0 +1,57 @@
+#
+# microbenchmark for FigureBuilder.add_lines nan-separated line assembly:
+# the old per-line loop vs render.join_lines, for uniform and ragged batches
+#
+#     PYTHONPATH=. python exp/bench_lines.py
+#
+
+import time
+
+import numpy as np
+
+from m3d.consumer import ragged
+from m3d.render import join_lines
+
+
+# the loop that add_lines used to use
+def join_lines_loop(lines):
+    dim = len(lines[0][0])
+    single = [lines[0]]
+    for line in lines[1:]:
+        single.append([[np.nan] * dim])
+        single.append(line)
+    return np.vstack(single).reshape((-1, dim))
+
+
+def timeit(f, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f(*args)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000, result
+
+
+def bench(n, dim=3):
+
+    rng = np.random.default_rng(0)
+
+    # uniform: n two-point segments, as from a mesh or a contour plot
+    uniform = rng.random((n, 2, dim))
+    t_loop, expected = timeit(join_lines_loop, uniform)
+    t_vec, actual = timeit(join_lines, None, uniform)
+    assert np.array_equal(expected, actual, equal_nan=True)
+    print(f"{n:>9} uniform   loop {t_loop:9.1f} ms   vectorized {t_vec:7.1f} ms   {t_loop/t_vec:6.1f}x")
+
+    # ragged: n lines of 2 to 5 points
+    lines = [rng.random((k, dim)) for k in rng.integers(2, 6, n)]
+    batch = ragged(lines)
+    t_loop, expected = timeit(join_lines_loop, lines)
+    t_vec, actual = timeit(join_lines, None, batch)
+    assert np.array_equal(expected, actual, equal_nan=True)
+    print(f"{n:>9} ragged    loop {t_loop:9.1f} ms   vectorized {t_vec:7.1f} ms   {t_loop/t_vec:6.1f}x")
+
+
+if __name__ == "__main__":
+    for n in [1_000, 100_000, 1_000_000]:
+        bench(n)
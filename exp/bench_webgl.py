@@ -0,0 +1,110 @@
+#
+# benchmark for choosing render.webgl_threshold: browser time to draw
+# ListPlot-like points and ListLinePlot-like lines as SVG (Scatter) vs WebGL (Scattergl)
+#
+# writes a self-contained html page that draws each case in turn and then shows
+# a table of timings; open it in the browser you care about:
+#
+#     PYTHONPATH=. python exp/bench_webgl.py /tmp/bench_webgl.html
+#
+# lines are drawn as given, and also decimated (render.decimate) as separate
+# rows, since decimation happens before the choice of trace type
+#
+# "draw" is Plotly.newPlot, "pan" is a relayout to a shifted x range,
+# which is roughly what interaction costs; times are best of 3, in ms
+#
+
+import json
+import sys
+
+import numpy as np
+import plotly.io
+import plotly.offline
+
+import m3d.render
+
+
+sizes = [1_000, 5_000, 10_000, 20_000, 50_000, 100_000, 200_000, 500_000]
+
+
+# just enough of GraphicsOptions for FigureBuilder
+class Options:
+    def __init__(self, webgl, decimate):
+        self.axes = [True, True]
+        self.axes_label = [None, None]
+        self.background = None
+        self.frame = False
+        self.image_size = [400, None]
+        self.log_plot = False
+        self.method = {"WebGL": webgl, "Decimate": decimate}
+        self.plot_range = [None, None]
+
+
+def figure(kind, n, webgl, decimate=False):
+    rng = np.random.default_rng(0)
+    xs = np.linspace(0, 10, n)
+    ys = np.cumsum(rng.normal(size=n)) / np.sqrt(n)
+    points = np.stack([xs, ys], axis=-1)
+    builder = m3d.render.FigureBuilder(2, None, Options(webgl, decimate))
+    if kind == "ListPlot":
+        builder.add_points(points, np.arange(n), None)
+    else:
+        builder.add_lines(points, np.arange(n)[None,:], None)
+    figure, _ = builder.figure()
+    return json.loads(plotly.io.to_json(figure))
+
+
+def main(fn):
+
+    cases = [
+        dict(
+            kind = kind + (" decimated" if decimate else ""), n = n,
+            type = "Scattergl" if webgl else "Scatter",
+            figure = figure(kind, n, webgl, decimate)
+        )
+        for kind, decimate in [("ListPlot", False), ("ListLinePlot", False), ("ListLinePlot", True)]
+        for n in sizes
+        for webgl in [False, True]
+    ]
+
+    script = """
+    async function run(cases) {
+        const rows = [];
+        const div = document.getElementById("plot");
+        for (const c of cases) {
+            let draw = Infinity, pan = Infinity;
+            for (let i = 0; i < 3; i++) {
+                Plotly.purge(div);
+                let t0 = performance.now();
+                await Plotly.newPlot(div, c.figure.data, c.figure.layout);
+                let t1 = performance.now();
+                await Plotly.relayout(div, {"xaxis.range": [1, 11]});
+                let t2 = performance.now();
+                draw = Math.min(draw, t1 - t0);
+                pan = Math.min(pan, t2 - t1);
+            }
+            rows.push(`<tr><td>${c.kind}</td><td>${c.n}</td><td>${c.type}</td>` +
+                      `<td>${draw.toFixed(1)}</td><td>${pan.toFixed(1)}</td></tr>`);
+            console.log(c.kind, c.n, c.type, draw.toFixed(1), pan.toFixed(1));
+        }
+        Plotly.purge(div);
+        document.getElementById("results").innerHTML =
+            "<tr><th>kind</th><th>n</th><th>type</th><th>draw</th><th>pan</th></tr>" + rows.join("");
+    }
+    """
+
+    html = f"""<html><head><meta charset="utf-8">
+    <script>{plotly.offline.get_plotlyjs()}</script>
+    </head><body>
+    <table id="results" border="1"><tr><td>running...</td></tr></table>
+    <div id="plot"></div>
+    <script>{script}; run({json.dumps(cases)});</script>
+    </body></html>"""
+
+    with open(fn, "w") as f:
+        f.write(html)
+    print("wrote", fn)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else "/tmp/bench_webgl.html")
@@ -138,6 +138,10 @@ class Pair(pn.Column):
 
     @util.Timer("execute code block")
     def update(self, expr=None):
+
+        # evaluating, and laying out, which can evaluate too, hold the session's lock
+        lock = util.evaluation_lock(self.top.session)
+        lock.acquire()
         try:
 
             expr_str = self.input.value_input
@@ -150,11 +154,14 @@ class Pair(pn.Column):
                 use_vectorized_plot = False if method == "classic" else True
                 mathics.builtin.drawing.plot.use_vectorized_plot = use_vectorized_plot
 
-            # evaluate it if not provided (e.g. from shell)
+            # evaluate it if not provided (e.g. from shell),
+            # keeping the unevaluated source so that plots can re-evaluate it on zoom
+            layout_options = {}
             if not expr:
                 session.evaluation.out.clear()
                 #expr = session.parse(expr)
                 expr = session.evaluate(expr_str)
+                layout_options["source"] = session.parse(expr_str)
 
             if expr is None:
                 # TODO: is this the right behavior?
@@ -162,7 +169,7 @@ class Pair(pn.Column):
             else:
 
                 # contruct layout from expr
-                layout = m3d.layout.expression_to_layout(self.top, expr)
+                layout = m3d.layout.expression_to_layout(self.top, expr, layout_options)
 
                 # either show it to user, or pass it to test
                 # can't do both because test "layout" mode requires
@@ -208,6 +215,7 @@ class Pair(pn.Column):
                 )
                 print(msg)
                 self.messages.append(msg)
+            lock.release()
 
         
 class View(pn.Column):
@@ -1,4 +1,5 @@
 import collections
+import functools
 import os
 from typing import Optional
 
@@ -21,83 +22,248 @@ from m3d import core, sym, util
 # indexes are converted from 1-based to 0-based TODO not yet
 # where possible, lists of items are coalesced by kind
 
-Waiting = collections.namedtuple("Waiting", ["kind", "vertices", "items", "colors"])
+# styles, if not None, is a list of [count, color, thickness] runs recording the
+# coalesced color and thickness of each waiting primitive (see coalesce_styles)
+Waiting = collections.namedtuple("Waiting", ["kind", "vertices", "items", "colors", "styles"])
+
+# per-primitive colors (n, 4) and thicknesses (n,) passed to FigureBuilder when
+# coalescing styles; nan means the builder's current style applies
+Styles = collections.namedtuple("Styles", ["colors", "thickness"])
+
+# if True, RGBColor and AbsoluteThickness directives between Polygons, Lines, or Points
+# don't break up the waiting items; instead the style of each primitive is recorded
+# in side arrays, letting FigureBuilder emit fewer, larger traces
+coalesce_styles = False
+coalescible_kinds = (sym.SymbolPolygon, sym.SymbolLine, sym.SymbolPoint)
+
+# a batch of items with differing numbers of vertices, in compressed (CSR-style) form:
+# item i is values[offsets[i]:offsets[i+1]], where values is either an (m, d) array
+# of coordinates or, inside a GraphicsComplex, an (m,) array of indexes into vertices
+Ragged = collections.namedtuple("Ragged", ["offsets", "values"])
+
+def ragged(items):
+    """ Pack a sequence of arrays of differing lengths into a Ragged batch """
+    items = [np.asarray(item) for item in items]
+    offsets = np.zeros(len(items) + 1, dtype=np.intp)
+    np.cumsum([len(item) for item in items], out=offsets[1:])
+    values = np.concatenate(items) if items else np.empty((0,))
+    return Ragged(offsets, values)
+
+#
+# bulk conversion of color expressions to an (..., 4) float32 RGBA array
+#
+
+def to_rgba(array):
+    """ Convert an (..., 3) RGB or (..., 4) RGBA array to a contiguous float32 RGBA array """
+    array = np.asarray(array, dtype=np.float32)
+    if array.shape[-1] == 4:
+        return np.ascontiguousarray(array)
+    rgba = np.ones(array.shape[:-1] + (4,), dtype=np.float32)
+    rgba[..., :3] = array
+    return rgba
+
+
+def hsb_to_rgb(h, s, b):
+    """ Vectorized conversion of hue, saturation, brightness arrays to r, g, b arrays """
+    h = (h % 1.0) * 6
+    i = np.floor(h).astype(int) % 6
+    f = h - np.floor(h)
+    p, q, t = b * (1 - s), b * (1 - s * f), b * (1 - s * (1 - f))
+    r = np.choose(i, [b, q, p, p, t, b])
+    g = np.choose(i, [t, b, b, q, p, p])
+    b = np.choose(i, [p, p, t, b, b, q])
+    return r, g, b
+
+
+def decode_colors(expr, wanted_depth):
+    """
+    Decode a nested List of RGBColor, Hue, GrayLevel, and Opacity expressions
+    into a float32 RGBA array in a single pass over the leaves. If the nesting is
+    regular the result has shape (..., 4) with at least wanted_depth dimensions;
+    otherwise it is flattened to (n, 4), which parallels the values of a Ragged batch.
+    """
+
+    def number(e):
+        try:
+            return float(e.value)
+        except (AttributeError, TypeError):
+            return float(e.to_python())
+
+    # flatten the leaves, collecting the first four components of each (nan if missing)
+    # and its kind: 0 for RGBColor, 1 for Hue, 2 for GrayLevel, and 3 for anything else
+    kinds = {sym.SymbolRGBColor: 0, sym.SymbolHue: 1, sym.SymbolGrayLevel: 2}
+    nan4 = (np.nan,) * 4
+    components = []
+    codes = []
+    alphas = {}
+    shape = []
+    leaf_depths = set()
+    def flatten(e, depth):
+        if e.head is sym.SymbolList:
+            if len(shape) <= depth:
+                shape.append(len(e.elements))
+            elif shape[depth] != len(e.elements):
+                shape[depth] = None
+            for element in e.elements:
+                flatten(element, depth + 1)
+            return
+        leaf_depths.add(depth)
+        if e.head is sym.SymbolOpacity:
+            # Opacity[a] or Opacity[a, color]
+            alphas[len(codes)] = number(e.elements[0])
+            if len(e.elements) < 2:
+                codes.append(0)
+                components.append((0.0, 0.0, 0.0, 1.0))
+                return
+            e = e.elements[1]
+        code = kinds.get(e.head, 3)
+        if code == 3:
+            c = tuple(core.expression_to_color(e).to_rgba())
+        else:
+            c = tuple(number(c) for c in e.elements[:4])
+        components.append(c + nan4[len(c):])
+        codes.append(code)
+    flatten(expr, 0)
+
+    # convert each kind of color in bulk
+    n = len(codes)
+    codes = np.array(codes, dtype=np.int8)
+    values = np.array(components, dtype=float).reshape((n, 4))
+    rgba = np.empty((n, 4), dtype=np.float32)
+    rgba[:, 3] = np.where(np.isnan(values[:, 3]), 1.0, values[:, 3])
+    rgb = (codes == 0) | (codes == 3)
+    rgba[rgb, :3] = values[rgb, :3]
+    hue = codes == 1
+    if hue.any():
+        h, s, b = values[hue, 0], values[hue, 1], values[hue, 2]
+        s, b = np.where(np.isnan(s), 1.0, s), np.where(np.isnan(b), 1.0, b)
+        rgba[hue, :3] = np.stack(hsb_to_rgb(h, s, b), axis=-1)
+    gray = codes == 2
+    if gray.any():
+        rgba[gray, :3] = values[gray, 0:1]
+        rgba[gray, 3] = np.where(np.isnan(values[gray, 1]), 1.0, values[gray, 1])
+    if alphas:
+        rgba[list(alphas.keys()), 3] = list(alphas.values())
+
+    # restore the nesting if it is regular
+    if None in shape or leaf_depths != {len(shape)}:
+        return rgba
+    rgba = rgba.reshape(tuple(shape) + (4,))
+    while rgba.ndim < wanted_depth:
+        rgba = rgba[np.newaxis]
+    return rgba
+
 
 class GraphicsOptions:
 
-    def __init__(self, dim, fe, expr, layout_options):
+    """
+    Graphics options, converted to python lazily: the option list is parsed once
+    into a dict of expressions, and each option is converted on first access
+    and memoized, so we only pay for the options that are actually used
+    """
 
-        graphics_options = expr.get_option_values(expr.elements[1:])
-
-        # gets option "name", converting to python
-        # System`Automatic is converted to None (TODO: ok?)
-        # quotes that to_python put around strings to distinguish from symbols are removed
-        # expands to a list of size want_list if requested
-        def get_option(name, want_list=None, default=None):
-            if name not in graphics_options:
-                return default
-            x = graphics_options[name].to_python()
-            def munge(x):
-                # TODO: how to distinguish? ... for auto maybe?
-                if x=="System`Automatic": x = None
-                elif x=="System`None": x = None
-                elif isinstance(x, str) and x[0]=='"': x = x[1:-1]
-                return x
-            if want_list:
-                if not isinstance(x, (list,tuple)):
-                    x = [x] * want_list
-                x.extend([None] * (want_list - len(x)))
-            if isinstance(x, (list,tuple)):
-                x = [munge(xx) for xx in x]
-            else:
-                x = munge(x)
+    def __init__(self, dim, fe, expr, layout_options):
+        self.dim = dim
+        self.fe = fe
+        self.layout_options = layout_options
+        self.graphics_options = expr.get_option_values(expr.elements[1:])
+        self.converted = {}
+
+    # gets option "name", converting to python
+    # System`Automatic is converted to None (TODO: ok?)
+    # quotes that to_python put around strings to distinguish from symbols are removed
+    # expands to a list of size want_list if requested
+    def get_option(self, name, want_list=None, default=None):
+        if name not in self.graphics_options:
+            return default
+        if name not in self.converted:
+            self.converted[name] = self.graphics_options[name].to_python()
+        x = self.converted[name]
+        def munge(x):
+            # TODO: how to distinguish? ... for auto maybe?
+            if x=="System`Automatic": x = None
+            elif x=="System`None": x = None
+            elif isinstance(x, str) and x[0]=='"': x = x[1:-1]
             return x
-
-        # NEXT
-        #boxed
-        #axes
-        #background
-        #axes_style
-        #label_style
-        #plot_range_padding
-        #tick_style
-        #if dim==3:
-        #    box_ratios
-        #    view_point
-        #    lighting
-        # TBD: add showscale, colorscale, boxed
-        # TBD: vertexcolors, colorscale, hue, etc.
-
-        # Axes
-        self.axes = get_option("System`Axes", 3)
-
-        # AxesLabel
-        # str -> [None, ..., str]
-        # [str, ...] -> [str, ..., None]
-        axes_label = get_option("System`AxesLabel")
+        if want_list:
+            if not isinstance(x, (list,tuple)):
+                x = [x] * want_list
+            x = list(x) + [None] * (want_list - len(x))
+        if isinstance(x, (list,tuple)):
+            x = [munge(xx) for xx in x]
+        else:
+            x = munge(x)
+        return x
+
+    # NEXT
+    #boxed
+    #axes
+    #background
+    #axes_style
+    #label_style
+    #plot_range_padding
+    #tick_style
+    #if dim==3:
+    #    box_ratios
+    #    view_point
+    #    lighting
+    # TBD: add showscale, colorscale, boxed
+    # TBD: vertexcolors, colorscale, hue, etc.
+
+    # full set not yet implemented:
+    #     AlignmentPoint, AxesOrigin, AxesStyle, BaselinePosition, BaseStyle,
+    #     ContentSelectable, CoordinatesToolOptions, Epilog, FormatType, FrameLabel,
+    #     FrameStyle, FrameTicks, FrameTicksStyle, GridLines, GridLinesStyle,
+    #     ImageMargins, ImagePadding, LabelStyle, PlotLabel, PlotRangeClipping,
+    #     PlotRangePadding, PlotRegion, PreserveImageOptions, Prolog, RotateLabel,
+    #     Ticks, TicksStyle
+    # and for 3d:
+    #     FaceGridsStyle, ViewCenter, ViewRange, ViewVertical, TouchscreenAutoZoom,
+    #     ViewVector, Lighting, ViewMatrix, ViewProjection, ClipPlanesStyle,
+    #     ControllerLinking, AxesEdge, RotationAction, ControllerPath, BoxStyle,
+    #     FaceGrids, ViewAngle, SphericalRegion, ClipPlanes
+
+    # Axes
+    @functools.cached_property
+    def axes(self):
+        return self.get_option("System`Axes", 3)
+
+    # AxesLabel
+    # str -> [None, ..., str]
+    # [str, ...] -> [str, ..., None]
+    @functools.cached_property
+    def axes_label(self):
+        dim = self.dim
+        axes_label = self.get_option("System`AxesLabel")
         if axes_label is None:
             axes_label = [None] * dim
         elif isinstance(axes_label, str):
             axes_label = ([None] * (dim-1)) + [axes_label]
         elif isinstance(axes_label, (list,tuple)):
             axes_label = axes_label + ([None] * (dim - len(axes_label)))
-        self.axes_label = axes_label
+        return axes_label
 
-        # Background
-        self.background = None
-        background = get_option("System`Background")
+    # Background
+    @functools.cached_property
+    def background(self):
+        background = self.get_option("System`Background")
         if background and background.head == sym.SymbolRGBColor:
-            self.background = [e.value for e in background.elements]
-
-        # Frame
-        self.frame = get_option("System`Frame")
-
-        # ImageSize, AspectRatio
-        image_size = get_option("System`ImageSize")
-        aspect_ratio = get_option("System`AspectRatio")
-        inside_row = layout_options.get("inside_row", False)
-        inside_grid = layout_options.get("inside_grid", False)
-        inside_list = layout_options.get("inside_list", False)
+            return [e.value for e in background.elements]
+        return None
+
+    # Frame
+    @functools.cached_property
+    def frame(self):
+        return self.get_option("System`Frame")
+
+    # ImageSize, AspectRatio
+    @functools.cached_property
+    def image_size(self):
+        image_size = self.get_option("System`ImageSize")
+        aspect_ratio = self.get_option("System`AspectRatio")
+        inside_row = self.layout_options.get("inside_row", False)
+        inside_grid = self.layout_options.get("inside_grid", False)
+        inside_list = self.layout_options.get("inside_list", False)
         auto_widths = {
             "System`Automatic": 400,
             "System`Tiny": 100,
@@ -122,86 +288,54 @@ class GraphicsOptions:
             else:
                 # auto, will be based on data
                 height = None
-        self.image_size = [width, height]
-        
-        # LogPlot
-        self.log_plot = get_option("System`LogPlot", False)
-
-        # PlotRange
-        self.plot_range = get_option("System`PlotRange", 3)
-
-        if dim == 3:
-
-            # Boxed
-            self.boxed = get_option("System`Boxed")
-
-            # BoxRatios
-            self.box_ratios = get_option("System`BoxRatios")            
-
-            # ViewPoint
-            self.view_point = get_option("System`ViewPoint")
-
-        # full set - comment out as implemented
-        alignment_point = get_option("System`AlignmentPoint")
-        aspect_ratio = get_option("System`AspectRatio")
-        axes = get_option("System`Axes")
-        axes_origin = get_option("System`AxesOrigin")
-        axes_style = get_option("System`AxesStyle")
-        baseline_position = get_option("System`BaselinePosition")
-        base_style = get_option("System`BaseStyle")
-        content_selectable = get_option("System`ContentSelectable")
-        coordinates_tool_options = get_option("System`CoordinatesToolOptions")
-        epilog = get_option("System`Epilog")
-        format_type = get_option("System`FormatType")
-        #frame = get_option("System`Frame")
-        frame_label = get_option("System`FrameLabel")
-        frame_style = get_option("System`FrameStyle")
-        frame_ticks = get_option("System`FrameTicks")
-        frame_ticks_style = get_option("System`FrameTicksStyle")
-        grid_lines = get_option("System`GridLines")
-        grid_lines_style = get_option("System`GridLinesStyle")
-        image_margins = get_option("System`ImageMargins")
-        image_padding = get_option("System`ImagePadding")
-        image_size = get_option("System`ImageSize")
-        label_style = get_option("System`LabelStyle")
-        method = get_option("System`Method")
-        plot_label = get_option("System`PlotLabel")
-        plot_range = get_option("System`PlotRange")
-        plot_range_clipping = get_option("System`PlotRangeClipping")
-        plot_range_padding = get_option("System`PlotRangePadding")
-        plot_region = get_option("System`PlotRegion")
-        preserve_image_options = get_option("System`PreserveImageOptions")
-        prolog = get_option("System`Prolog")
-        rotate_label = get_option("System`RotateLabel")
-        ticks = get_option("System`Ticks")
-        ticks_style = get_option("System`TicksStyle")
-        if dim == 3:
-            face_grids_style = get_option("System`FaceGridsStyle")
-            boxed = get_option("System`Boxed")
-            view_center = get_option("System`ViewCenter")
-            view_range = get_option("System`ViewRange")
-            view_vertical = get_option("System`ViewVertical")
-            touchscreen_auto_zoom = get_option("System`TouchscreenAutoZoom")
-            view_vector = get_option("System`ViewVector")
-            lighting = get_option("System`Lighting")
-            view_matrix = get_option("System`ViewMatrix")
-            view_projection = get_option("System`ViewProjection")
-            clip_planes_style = get_option("System`ClipPlanesStyle")
-            controller_linking = get_option("System`ControllerLinking")
-            #view_point = get_option("System`ViewPoint")
-            axes_edge = get_option("System`AxesEdge")
-            rotation_action = get_option("System`RotationAction")
-            #box_ratios = get_option("System`BoxRatios")
-            controller_path = get_option("System`ControllerPath")
-            box_style = get_option("System`BoxStyle")
-            face_grids = get_option("System`FaceGrids")
-            view_angle = get_option("System`ViewAngle")
-            spherical_region = get_option("System`SphericalRegion")
-            clip_planes = get_option("System`ClipPlanes")
-
-
-        #for n, v in graphics_options.items(): print(n, v)
-        #for n, v in self.__dict__.items(): print(n, v)
+        return [width, height]
+
+    # LogPlot
+    @functools.cached_property
+    def log_plot(self):
+        return self.get_option("System`LogPlot", False)
+
+    # PlotRange
+    @functools.cached_property
+    def plot_range(self):
+        return self.get_option("System`PlotRange", 3)
+
+    # Boxed (3d)
+    @functools.cached_property
+    def boxed(self):
+        return self.get_option("System`Boxed")
+
+    # BoxRatios (3d)
+    @functools.cached_property
+    def box_ratios(self):
+        return self.get_option("System`BoxRatios")
+
+    # ViewPoint (3d)
+    @functools.cached_property
+    def view_point(self):
+        return self.get_option("System`ViewPoint")
+
+    # Method -> {"name" -> value, ...}
+    # per-graphics overrides of our rendering choices, e.g. "WebGL" -> True
+    # returns a dict of python values, with Automatic as None
+    @functools.cached_property
+    def method(self):
+        method = self.graphics_options.get("System`Method")
+        rules = []
+        if method is not None and method.head is sym.SymbolList:
+            rules = method.elements
+        elif method is not None and method.head is sym.SymbolRule:
+            rules = [method]
+        result = {}
+        for rule in rules:
+            if rule.head is sym.SymbolRule:
+                name, value = (e.to_python() for e in rule.elements)
+                if isinstance(name, str) and name[0] == '"':
+                    name = name[1:-1]
+                if value in ("System`Automatic", "System`None"):
+                    value = None
+                result[name] = value
+        return result
 
 class GraphicsConsumer:
 
@@ -212,6 +346,10 @@ class GraphicsConsumer:
     # this coalesces consecutive items of the same kind
     waiting = None
 
+    # directives recorded against waiting items when coalescing styles,
+    # to be passed on to FigureBuilder when they are flushed
+    pending: dict = {}
+
     def __init__(self, fe, expr, layout_options):
 
         assert expr.head in (sym.SymbolGraphics, sym.SymbolGraphics3D, sym.SymbolGraphicsBox, sym.SymbolGraphics3DBox)
@@ -221,6 +359,7 @@ class GraphicsConsumer:
         self.expr = expr
         self.vertices = None
         self.graphics = expr.elements[0]
+        self.pending = {}
 
         # TODO: these are not being passed through
         self.options = GraphicsOptions(self.dim, fe, expr, layout_options)
@@ -239,29 +378,18 @@ class GraphicsConsumer:
         if expr is None:
             return
 
-        def to_rgb(colors):
-            if colors is None:
-                return
-            extract = lambda color: tuple(c.to_python() for c in color.elements)
-            extract = np.vectorize(extract)
-            colors = np.array(extract(colors))
-            colors = colors.transpose(1, 2, 0) # np.vectorize wonky behavior...
-            return colors
-                
         for e in expr.elements[1:]:
             if e.head is sym.SymbolRule and e.elements[0] is sym.SymbolVertexColors:
                 colors_expr = e.elements[1]
-                if colors_expr.head == sym.SymbolRGBColor:
+                if isinstance(colors_expr, core.NumericArray):
+                    return to_rgba(colors_expr.value)
+                elif colors_expr.head == sym.SymbolRGBColor:
                     colors = colors_expr.elements[0]
                     if isinstance(colors, core.NumericArray):
-                        #print(colors.value)
-                        return colors.value
+                        return to_rgba(colors.value)
                 elif colors_expr.head is sym.SymbolList:
-                    colors = self.list_or_array(colors_expr, wanted_depth)
-                    colors = np.array(colors)
                     with util.Timer("vertex colors to rgb"):
-                        colors = np.array([to_rgb(np.array(c)) for c in colors])
-                    return colors
+                        return decode_colors(colors_expr, wanted_depth)
 
 
     def list_or_array(self, expr, wanted_depth):
@@ -312,59 +440,147 @@ class GraphicsConsumer:
                 
         # convert 1-based indexes to 0-based if in GraphicsComplex
         if self.vertices is not None:
-            for item in items:
-                item -= 1
+            for i, item in enumerate(items):
+                if isinstance(item, np.ndarray):
+                    item -= 1
+                else:
+                    # differing numbers of vertices, e.g. Polygon[{{1,2,3},{4,5,6,7}}]
+                    items[i] = [np.asarray(prim) - 1 for prim in item]
 
         # flush if needed, add our items to waiting items
         if self.waiting is None:
-            self.waiting = Waiting(kind, self.vertices, items, colors)
+            self.waiting = Waiting(kind, self.vertices, items, colors, [])
         # TODO: what about colors?
         elif self.waiting.kind == kind and self.waiting.vertices is self.vertices:
             self.waiting.items.extend(items)
         else:
             yield from self.flush()
-            self.waiting = Waiting(kind, self.vertices, items, colors)
+            self.waiting = Waiting(kind, self.vertices, items, colors, [])
+
+        # record the style of our primitives, one per vertex for Points
+        if kind in coalescible_kinds:
+            color = self.pending.get(sym.SymbolRGBColor)
+            thickness = self.pending.get(sym.SymbolAbsoluteThickness)
+            self.waiting.styles.append([sum(len(item) for item in items), color, thickness])
+
+    def pack(self, kind, vertices, items, colors):
+        """
+        Pack waiting Polygon, Line, or Point items that have differing numbers
+        of vertices into a single Ragged batch, with colors (if any) flattened
+        to parallel the Ragged values
+        """
+
+        # each Polygon or Line item holds a list of primitives, either as a
+        # uniform array or as a list of arrays; each Point item is a single primitive
+        lengths, values = [], []
+        for item in items:
+            if kind == sym.SymbolPoint:
+                item = [item]
+            if isinstance(item, np.ndarray) and item.dtype != object:
+                lengths.append(np.full(len(item), item.shape[1]))
+                values.append(item.reshape((-1,) + item.shape[2:]))
+            else:
+                prims = [np.asarray(prim) for prim in item]
+                lengths.append([len(prim) for prim in prims])
+                values.extend(prims)
+        offsets = np.zeros(sum(len(l) for l in lengths) + 1, dtype=np.intp)
+        np.cumsum(np.concatenate(lengths), out=offsets[1:])
+        batch = Ragged(offsets, np.concatenate(values))
+
+        # in a GraphicsComplex colors parallel vertices and need no change;
+        # otherwise they parallel the inline coordinates
+        if colors is not None and vertices is None:
+            try:
+                colors = np.asarray(colors, dtype=float)
+                colors = colors.reshape((-1, colors.shape[-1]))
+            except ValueError:
+                colors = None
+            if colors is not None and len(colors) != len(batch.values):
+                colors = None
+
+        return batch, colors
 
     def flush(self):
         """ Flush any waiting items """
         if self.waiting is not None:
 
             # stack items if possible for more efficent processing
-            items, colors = self.waiting.items, self.waiting.colors
+            # if they have differing numbers of vertices pack them into a Ragged batch
+            kind, vertices, items, colors, styles = self.waiting
             try:
                 items = [np.vstack(items)]
                 colors = [np.vstack(colors)] if colors is not None else None
             except (ValueError, TypeError):
-                pass
+                if kind in (sym.SymbolPolygon, sym.SymbolLine, sym.SymbolPoint):
+                    items, colors = self.pack(kind, vertices, items, colors)
+                    items, colors = [items], [colors]
                 #shapes = np.array([item.shape for item in items])
                 #print(f"can't stack {len(items)} {self.waiting.kind} {shapes}")
 
             colors = colors if colors is not None else [None] * len(items)
+            styles = self.styles(styles) if len(items) == 1 else None
             for item, color in zip(items, colors):
-                yield self.waiting.kind, self.waiting.vertices, item, color
+                if styles is None:
+                    yield kind, vertices, item, color
+                else:
+                    yield kind, vertices, item, color, styles
 
             self.waiting = None
 
+            # directives that were recorded against the waiting items now apply to future items
+            for directive, value in self.pending.items():
+                yield directive, value, None
+            self.pending = {}
+
+    def styles(self, runs):
+        """ Expand [count, color, thickness] runs into Styles, or None if all are default """
+        if all(color is None and thickness is None for _, color, thickness in runs):
+            return None
+        counts = [count for count, _, _ in runs]
+        colors = [(np.nan,) * 4 if color is None else tuple(color) + (1.0,) * (4 - len(color))
+                  for _, color, _ in runs]
+        thickness = [np.nan if thickness is None else thickness for _, _, thickness in runs]
+        return Styles(
+            np.repeat(np.array(colors, dtype=float), counts, axis=0),
+            np.repeat(np.array(thickness, dtype=float), counts),
+        )
+
+    def directive(self, directive):
+        """
+        Yield a color or thickness directive, first flushing waiting items so that it
+        only applies to future items. If coalescing styles, a plain directive between
+        coalescible items is instead recorded against the waiting items.
+        """
+        kind, value, ctx = directive
+        if coalesce_styles and ctx is None and self.waiting is not None \
+            and self.waiting.kind in coalescible_kinds:
+            self.pending[kind] = value
+            return
+        yield from self.flush()
+        yield directive
+
     def process(self, expr, colors=None):
 
         def directives(ctx, expr):
 
-            # any directive requires that we flush pending
-            # so that directive only applies to future
-            yield from self.flush()
+            # any directive requires that we flush pending so that directive
+            # only applies to future; self.directive takes care of that for
+            # colors and thicknesses, which may be coalesced instead
 
             # is it a color?
             # TODO: this seems heavy-handed - is there a better way?
             try:
                 color = core.expression_to_color(expr)
                 rgba = color.to_rgba()
-                yield (sym.SymbolRGBColor, rgba, ctx)
-                return
             except:
-                pass
+                rgba = None
+
+            if rgba is not None:
+                yield from self.directive((sym.SymbolRGBColor, rgba, ctx))
 
-            if expr.head == sym.SymbolAbsoluteThickness:
-                yield (sym.SymbolAbsoluteThickness, expr.elements[0].to_python(), ctx)
+            elif expr.head == sym.SymbolAbsoluteThickness:
+                thickness = expr.elements[0].to_python()
+                yield from self.directive((sym.SymbolAbsoluteThickness, thickness, ctx))
 
             elif expr.head == sym.SymbolList:
                 for e in expr.elements:
@@ -384,6 +600,7 @@ class GraphicsConsumer:
 
             elif expr.head in (sym.SymbolStyle, sym.SymbolStyleBox):
                 # TODO: do we need to push/pop context?
+                yield from self.flush()
                 yield (sym.SymbolStyle, 1)
                 for e in expr.elements[1:]:
                     yield from directives(None, e)
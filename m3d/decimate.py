@@ -0,0 +1,70 @@
+#
+# Decimation of long 2d lines, e.g. ListLinePlot of a long time series,
+# down to about what can be seen at the plot's pixel resolution.
+#
+# For each line segment whose x is monotonic we divide x into one bucket per
+# pixel and keep only the first, last, min-y, and max-y point of each bucket,
+# in their original order, so 2-4 points per pixel. That draws the same vertical
+# extent in every pixel column as the full line, and connects to the neighboring
+# columns at the same points. Segments that double back in x, e.g. parametric
+# curves, are left alone. nan breaks between segments are kept.
+#
+
+import numpy as np
+
+from m3d import util
+
+
+# decimate 2d lines; overridden for individual graphics by Method -> {"Decimate" -> True|False}
+enabled = True
+
+# only decimate lines with more than this many points per pixel
+min_points_per_pixel = 4
+
+
+# lines is an (n, 2) array of nan-separated line segments, as from render.join_lines,
+# covering npixels horizontally. Returns the rows of lines to draw.
+@util.Timer("decimate")
+def decimate(lines, npixels):
+
+    n = len(lines)
+    if n <= npixels * min_points_per_pixel:
+        return lines
+    x, y = lines[:,0], lines[:,1]
+
+    # rows with a nan separate segments
+    breaks = np.isnan(lines).any(axis=1)
+    segment = np.cumsum(breaks)
+
+    # segments whose x never decreases, or never increases
+    dx = np.diff(x)
+    inside = ~breaks[1:] & ~breaks[:-1]
+    nsegments = segment[-1] + 1
+    ups = np.bincount(segment[1:][inside & (dx > 0)], minlength=nsegments)
+    downs = np.bincount(segment[1:][inside & (dx < 0)], minlength=nsegments)
+    monotonic = (ups == 0) | (downs == 0)
+
+    # runs of consecutive points in the same segment and pixel bucket;
+    # breaks get buckets of their own
+    lo, hi = np.nanmin(x), np.nanmax(x)
+    bucket = np.floor((x - lo) / max(hi - lo, np.finfo(float).tiny) * npixels)
+    bucket = np.where(breaks, -1, np.clip(bucket, 0, npixels - 1))
+    change = np.empty(n, dtype=bool)
+    change[0] = True
+    change[1:] = (bucket[1:] != bucket[:-1]) | breaks[1:] | breaks[:-1]
+    starts = np.flatnonzero(change)
+    ends = np.append(starts[1:], n) - 1
+    run = np.cumsum(change) - 1
+
+    # index of the first min and max y in each run
+    index = np.arange(n)
+    y = np.where(breaks, 0, y)
+    is_min = y == np.minimum.reduceat(y, starts)[run]
+    is_max = y == np.maximum.reduceat(y, starts)[run]
+    mins = np.minimum.reduceat(np.where(is_min, index, n), starts)
+    maxs = np.minimum.reduceat(np.where(is_max, index, n), starts)
+
+    keep = breaks | ~monotonic[segment]
+    keep[starts] = keep[ends] = keep[mins] = keep[maxs] = True
+
+    return lines[keep]
@@ -0,0 +1,91 @@
+#
+# Recognizing vertex colors that lie along a 1-d color gradient, as they do when
+# a ColorFunction maps a scalar to a color, e.g. ColorFunction -> (Hue[#3]&) or
+# a Blend of two colors. Such colors can be sent as one intensity per vertex plus
+# a colorscale instead of an rgb triple per vertex, which is 3-4x smaller and
+# lets Plotly draw a colorbar.
+#
+# We try a straight line through rgb space fitted by principal components, which
+# covers GrayLevel and two-color blends, then the known piecewise-linear gradients
+# below. Colors must be within tolerance of the gradient, about what 8-bit color
+# can show, and fully opaque.
+#
+
+from collections import namedtuple
+
+import numpy as np
+
+from m3d import util
+
+
+# send colors on a gradient as intensity plus colorscale;
+# overridden for individual graphics by Method -> {"Intensity" -> True|False}
+enabled = True
+
+# largest allowed distance of a color from the gradient in any rgb component
+tolerance = 1.5 / 255
+
+# known gradients, as evenly spaced rgb stops
+gradients = {
+    "Hue": [[1,0,0], [1,1,0], [0,1,0], [0,1,1], [0,0,1], [1,0,1], [1,0,0]],
+}
+
+
+# intensity is an array of values from 0 to 1, one per color, that colorscale,
+# a Plotly colorscale, maps back to the colors
+Gradient = namedtuple("Gradient", ["intensity", "colorscale"])
+
+
+def colorscale(stops):
+    stops = np.round(np.asarray(stops) * 255).astype(int)
+    return [
+        [i / (len(stops) - 1), "rgb({},{},{})".format(*rgb)]
+        for i, rgb in enumerate(stops)
+    ]
+
+
+# Fit rgb colors to a straight line between two colors
+def fit_line(rgb):
+    mean = rgb.mean(axis=0)
+    centered = rgb - mean
+    _, vectors = np.linalg.eigh(centered.T @ centered)
+    direction = vectors[:,-1]
+    t = centered @ direction
+    lo, hi = t.min(), t.max()
+    if hi - lo < tolerance:
+        return None
+    if np.abs(centered - t[:,None] * direction).max() > tolerance:
+        return None
+    stops = np.clip(mean + np.outer([lo, hi], direction), 0, 1)
+    return Gradient((t - lo) / (hi - lo), colorscale(stops))
+
+
+# Fit rgb colors to the piecewise-linear gradient through evenly spaced stops
+def fit_stops(rgb, stops):
+    stops = np.asarray(stops, dtype=float)
+    a, d = stops[:-1], np.diff(stops, axis=0)
+    s = np.einsum("nsc,sc->ns", rgb[:,None,:] - a, d) / (d * d).sum(axis=1)
+    s = np.clip(s, 0, 1)
+    error = np.abs(rgb[:,None,:] - (a + s[...,None] * d)).max(axis=2)
+    segment = np.argmin(error, axis=1)
+    rows = np.arange(len(rgb))
+    if error[rows, segment].max() > tolerance:
+        return None
+    return Gradient((segment + s[rows, segment]) / len(d), colorscale(stops))
+
+
+# If colors, an (n, 3) or (n, 4) array, lie along a gradient return a
+# Gradient for them, else None
+@util.Timer("fit gradient")
+def fit(colors):
+    if len(colors) < 2 or not np.isfinite(colors).all():
+        return None
+    if colors.shape[1] == 4 and (colors[:,3] != 1).any():
+        return None
+    rgb = colors[:,:3].astype(float)
+    gradient = fit_line(rgb)
+    for stops in gradients.values():
+        if gradient is not None:
+            break
+        gradient = fit_stops(rgb, stops)
+    return gradient
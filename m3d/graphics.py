@@ -16,6 +16,7 @@ from m3d import core, sym, util
 import m3d.layout
 import m3d.ui
 import m3d.render
+import m3d.zoom
 
 from m3d.consumer import GraphicsConsumer
 
@@ -42,7 +43,11 @@ def layout_GraphicsBox(dim, fe, expr, layout_options):
         switch[item[0]](*item[1:])
 
     figure, height = builder.figure()
-    layout = m3d.ui.graph(figure, height)
+
+    # zooming a 2d plot re-evaluates its source expression if we know how
+    on_zoom = m3d.zoom.resampler(fe, layout_options.get("source")) if dim == 2 else None
+
+    layout = m3d.ui.graph(figure, height, on_zoom)
     return layout
 
 #
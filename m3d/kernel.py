@@ -0,0 +1,323 @@
+"""
+Compiled numeric kernels for Manipulate. For a Plot, Plot3D, or ParametricPlot
+target, only the slider values change from one update to the next, so rather
+than re-running the evaluator (option processing, sampling, boxing) and the
+graphics pipeline, we lambdify the plotted functions once, with the iterator
+variables and the sliders as arguments, and on each update re-evaluate them
+over the samples of the first figure and patch its trace arrays directly.
+
+A kernel is only used if it reproduces the figure produced by the full
+evaluation of the initial slider values; anything we can't compile or match
+is left to the full evaluation path. That includes where the holes in a
+surface are, which we recompute for each update from the function values and
+any PlotRange clipping, and where curves are broken, which we can't, so we
+don't compile curves with breaks within them. Nor do we compile surfaces
+colored by a ColorFunction, since we only have the plotted function.
+"""
+
+import copy
+
+import numpy as np
+import panel as pn
+import plotly.graph_objects as go
+import sympy
+from sympy.core.function import AppliedUndef
+
+from m3d import sym, util
+import m3d.transport
+import m3d.ui
+
+
+# compile Manipulate targets where possible
+enabled = True
+
+# plotting functions we can compile, with their number of leading {v, lo, hi} iterators
+domains = {
+    sym.SymbolPlot: 1,
+    sym.SymbolParametricPlot: 1,
+    sym.SymbolPlot3D: 2,
+}
+
+# a kernel must match the full evaluation to within this fraction of the data extent
+tolerance = 1e-5
+
+
+# Lambdify expr, a held expression, as a numpy function of the variables named
+# by names, without context. Returns None if expr can't be converted to sympy,
+# or depends on anything else.
+def lambdify(expr, names):
+    try:
+        expr = expr.to_sympy()
+    except Exception:
+        return None
+    if not isinstance(expr, sympy.Basic) or expr.atoms(AppliedUndef):
+        return None
+    by_name = {str(s).split("`")[-1]: s for s in expr.free_symbols}
+    if not set(by_name) <= set(names):
+        return None
+    args = [by_name.get(name, sympy.Dummy(name)) for name in names]
+    try:
+        f = sympy.lambdify(args, expr, modules="numpy")
+    except Exception:
+        return None
+
+    # real values, nan where complex or undefined, with the shape of the first argument
+    def call(*values):
+        with np.errstate(all="ignore"):
+            try:
+                v = np.asarray(f(*values))
+            except (ArithmeticError, TypeError, ValueError):
+                return None
+        if np.iscomplexobj(v):
+            v = np.where(np.abs(v.imag) <= 1e-12 * np.abs(v.real), v.real, np.nan)
+        return np.broadcast_to(v.astype(float), np.shape(values[0]) if values else ())
+
+    return call
+
+
+# the names of the iterator variables of target, or None if they aren't all {v, lo, hi}
+def iterator_names(iterators):
+    names = []
+    for it in iterators:
+        if getattr(it, "head", None) is not sym.SymbolList or len(it.elements) != 3:
+            return None
+        name = getattr(it.elements[0], "get_name", lambda: None)()
+        if not name:
+            return None
+        names.append(name.split("`")[-1])
+    return names
+
+
+# For each point of a trace whose coordinates are the arrays of coords, the index
+# of the function in functions that computes its last coordinate from the others
+# (found separately for each nan-separated segment), or -1 for breaks. Returns
+# None if some segment matches no function.
+def match_segments(coords, functions, args):
+    breaks = np.isnan(coords[0])
+    segment = np.cumsum(breaks)
+    nsegments = segment[-1] + 1 if len(segment) else 0
+    which = np.full(nsegments, -1)
+    target = coords[-1]
+    atol = tolerance * max(np.nanmax(target) - np.nanmin(target), 1) if (~breaks).any() else 0
+    for k, f in enumerate(functions):
+        v = f(*coords[:-1], *args)
+        if v is None:
+            continue
+        ok = np.isclose(v, target, rtol=tolerance, atol=atol, equal_nan=True) | breaks
+        good = np.bincount(segment, weights=~ok, minlength=nsegments) == 0
+        which = np.where((which < 0) & good, k, which)
+    which = np.where(breaks, -1, which[segment])
+    if ((which < 0) & ~breaks).any():
+        return None
+    return which
+
+
+# The [lo, hi] that PlotRange in options limits the last coordinate to,
+# or None if it doesn't
+def clip_range(options, dim):
+    for o in options:
+        if getattr(o, "head", None) is sym.SymbolRule and o.elements[0] is sym.SymbolPlotRange:
+            r = o.elements[1].to_python()
+            if isinstance(r, (list, tuple)) and len(r) == dim and all(isinstance(a, (list, tuple)) for a in r):
+                r = r[-1]
+            if isinstance(r, (list, tuple)) and len(r) == 2 and all(
+                isinstance(a, (int, float)) and not isinstance(a, bool) for a in r
+            ):
+                return [float(r[0]), float(r[1])]
+    return None
+
+
+# Where a surface over a lattice has holes, given its z values: where they
+# are non-finite or clipped, or with by_quad, at lattice points none of
+# whose quads has all corners where they aren't
+def surface_holes(z, clip, by_quad):
+    with np.errstate(invalid="ignore"):
+        bad = ~np.isfinite(z)
+        if clip is not None:
+            bad |= (z < clip[0]) | (z > clip[1])
+    if not by_quad:
+        return bad
+    good = ~bad
+    quad = good[:-1,:-1] & good[:-1,1:] & good[1:,:-1] & good[1:,1:]
+    present = np.zeros_like(good)
+    present[:-1,:-1] |= quad
+    present[:-1,1:] |= quad
+    present[1:,:-1] |= quad
+    present[1:,1:] |= quad
+    return ~present
+
+
+# Given the held target of a Manipulate, the names of its sliders, and the layout
+# from the full evaluation of the initial slider values, returns a function
+# evaluate(values) that returns a layout for new slider values, or None if the
+# target can't be compiled.
+@util.Timer("compile kernel")
+def compiler(target, slider_names, initial_values, layout):
+
+    if not enabled or getattr(target, "head", None) not in domains:
+        return None
+    if not isinstance(layout, pn.pane.Plotly) or not isinstance(layout.object, go.Figure):
+        return None
+    parametric = target.head is sym.SymbolParametricPlot
+    n = domains[target.head]
+    f, iterators, options = target.elements[0], target.elements[1:1+n], target.elements[1+n:]
+    variables = iterator_names(iterators)
+    if len(iterators) < n or variables is None:
+        return None
+    fixed_range = any(
+        getattr(o, "head", None) is sym.SymbolRule and o.elements[0] is sym.SymbolPlotRange
+        for o in options
+    )
+    clip = clip_range(options, 3 if target.head is sym.SymbolPlot3D else 2)
+
+    # the functions, and iterator bounds, which may depend on the sliders
+    functions = f.elements if f.head is sym.SymbolList else [f]
+    if parametric:
+        if len(functions) != 2 or any(g.head is sym.SymbolList for g in functions):
+            return None
+    functions = [lambdify(g, variables + slider_names) for g in functions]
+    bounds = [lambdify(b, slider_names) for it in iterators for b in it.elements[1:]]
+    if None in functions or None in bounds:
+        return None
+    def domain(values):
+        lohi = [b(*values) for b in bounds]
+        return np.array([float(v) if v is not None else np.nan for v in lohi]).reshape(-1, 2)
+    initial_domain = domain(initial_values)
+    if not np.isfinite(initial_domain).all():
+        return None
+
+    # we patch our own copy of the figure
+    figure = layout.object
+    height = getattr(layout, "_m3d_height", None)
+    data = [t.to_plotly_json() for t in figure.data]
+    base_layout = figure.layout.to_plotly_json()
+    dim = 3 if target.head is sym.SymbolPlot3D else 2
+    axes = "xyz"[:dim]
+    coords = [[m3d.transport.array(t[c]).astype(float) for c in axes if c in t] for t in data]
+
+    def close(a, b):
+        extent = np.nanmax(b) - np.nanmin(b) if np.isfinite(b).any() else 0
+        return np.allclose(a, b, rtol=tolerance, atol=tolerance * max(extent, 1), equal_nan=True)
+
+    # how each trace is computed: its kind, and for curves which function computes
+    # each point, or for surfaces how holes are made (see surface_holes)
+    kinds = []
+    for t, c in zip(data, coords):
+        if t.get("name") == "box":
+            kinds.append(("box", None))
+        elif parametric:
+            if t["type"] not in ("scatter", "scattergl") or len(data) != 1 or np.isnan(c[0]).any():
+                return None
+            u = np.linspace(*initial_domain[0], len(c[0]))
+            ends = [g(u[[0,-1]], *initial_values) for g in functions]
+            if not all(e is not None and close(e, cc[[0,-1]]) for e, cc in zip(ends, c)):
+                return None
+            kinds.append(("parametric", None))
+        elif t["type"] == "surface" and dim == 3 and "surfacecolor" not in t:
+            z = functions[0](*np.meshgrid(c[0], c[1]), *initial_values) if len(functions) == 1 else None
+            if z is None:
+                return None
+            holes = np.isnan(c[2])
+            for by_quad in (False, True):
+                if np.array_equal(surface_holes(z, clip, by_quad), holes):
+                    break
+            else:
+                return None
+            if not close(np.where(holes, np.nan, z), c[2]):
+                return None
+            kinds.append(("surface", by_quad))
+        elif t["type"] in ("scatter", "scattergl", "scatter3d") and t.get("mode") == "lines" and len(c) == dim:
+            which = match_segments(c, functions, initial_values)
+            if which is None:
+                return None
+            # each function must be a single unbroken segment
+            segment = np.cumsum(np.isnan(c[0]))
+            for k in range(len(functions)):
+                if len(np.unique(segment[which == k])) > 1:
+                    return None
+            kinds.append(("curve", which))
+        else:
+            return None
+
+    # range of the data in each axis, not counting the box
+    def data_range(coords):
+        values = [[] for _ in axes]
+        for c, (kind, _) in zip(coords, kinds):
+            if kind != "box":
+                for i, a in enumerate(c):
+                    values[i].append(np.ravel(a))
+        values = [np.concatenate(v) if v else np.full(1, np.nan) for v in values]
+        return np.array([
+            [np.nanmin(v), np.nanmax(v)] if np.isfinite(v).any() else [np.nan, np.nan]
+            for v in values
+        ])
+    initial_range = data_range(coords)
+    axis_ranges = [
+        (base_layout["scene"] if dim == 3 else base_layout).get(axis + "axis", {}).get("range")
+        for axis in axes
+    ]
+
+    def evaluate(values):
+
+        # map samples from the initial domain to the current one
+        d = domain(values)
+        if not np.isfinite(d).all():
+            return None
+        scale = (d[:,1] - d[:,0]) / np.where(initial_domain[:,1] > initial_domain[:,0], initial_domain[:,1] - initial_domain[:,0], 1)
+        def remap(a, i):
+            return d[i,0] + (a - initial_domain[i,0]) * scale[i]
+
+        new_coords = []
+        for c, (kind, how) in zip(coords, kinds):
+            if kind == "parametric":
+                u = np.linspace(*d[0], len(c[0]))
+                c = [functions[0](u, *values), functions[1](u, *values)]
+            elif kind == "surface":
+                xs, ys = remap(c[0], 0), remap(c[1], 1)
+                z = functions[0](*np.meshgrid(xs, ys), *values)
+                if z is not None:
+                    z = np.where(surface_holes(z, clip, how), np.nan, z)
+                c = [xs, ys, z]
+            elif kind == "curve":
+                ins = [remap(a, i) for i, a in enumerate(c[:-1])]
+                out = np.full(len(c[-1]), np.nan)
+                for k, g in enumerate(functions):
+                    mask = how == k
+                    if mask.any():
+                        out[mask] = g(*[a[mask] for a in ins], *values)
+                c = [*ins, out]
+            elif kind == "box":
+                # rescaled below; copied so the initial box stays as it was
+                c = list(c)
+            new_coords.append(c)
+        if any(a is None for c in new_coords for a in c):
+            return None
+
+        # new axis ranges, padded as the initial ones were, and a box to match
+        new_layout = copy.deepcopy(base_layout)
+        new_axis_layout = new_layout["scene"] if dim == 3 else new_layout
+        new_range = data_range(new_coords)
+        for i, axis in enumerate(axes):
+            (lo, hi), (old_lo, old_hi), r = new_range[i], initial_range[i], axis_ranges[i]
+            if fixed_range or r is None or not (hi > lo and old_hi > old_lo):
+                continue
+            s = (hi - lo) / (old_hi - old_lo)
+            new_r = [float(lo - (old_lo - r[0]) * s), float(hi + (r[1] - old_hi) * s)]
+            new_axis_layout[axis + "axis"]["range"] = new_r
+            for c, (kind, _) in zip(new_coords, kinds):
+                if kind == "box":
+                    c[i] = new_r[0] + (c[i] - r[0]) * s
+
+        traces = []
+        for t, c in zip(data, new_coords):
+            t = dict(t)
+            for axis, a in zip(axes, c):
+                t[axis] = a
+            traces.append(t)
+        if m3d.transport.enabled:
+            m3d.transport.compact(traces)
+
+        new_figure = go.Figure(data=traces, layout=new_layout, _validate=False)
+        return m3d.ui.graph(new_figure, height)
+
+    return evaluate
@@ -12,6 +12,7 @@ mathics.builtin.drawing.plot.use_vectorized_plot = True
 
 from m3d import core, sym, util # noqa
 import m3d.app
+import m3d.transport
 
 
 #
@@ -49,6 +50,7 @@ else:
     parser.add_argument("--test", action="store_true")
     parser.add_argument("--test-ui", action="store_true")
     parser.add_argument("--classic", action="store_true")
+    parser.add_argument("--binary-transport", action="store_true")
     parser.add_argument("--browser", "-b", default=None)
     parser.add_argument("file", nargs="*", type=str)
     args = parser.parse_args()
@@ -56,6 +58,9 @@ else:
     # use vectorized plotting by default
     mathics.builtin.drawing.plot.use_vectorized_plot = not args.classic
 
+    # send figure data as compact binary arrays
+    m3d.transport.enabled = args.binary_transport
+
     # trigger tests if requested
     if args.test:
         import test.test
@@ -1,12 +1,15 @@
 import collections
 import itertools
 import os
+import threading
 
 import numpy as np
+import plotly.graph_objects as go
 from mathics.core.builtin import Builtin
 from mathics.core.load_builtin import add_builtins
 
 from m3d import core, sym, util
+import m3d.kernel
 import m3d.layout
 import m3d.ui
 import m3d.render
@@ -59,6 +62,164 @@ class ManipulateBox(core.BoxExpression):
 add_builtins([("System`Manipulate", Manipulate(expression=False))])
 
 
+#
+# Coarse evaluation while dragging. A target that is a call to one of these
+# plotting functions is evaluated with PlotPoints reduced to at most the given
+# number and MaxRecursion -> 0 while a slider is moving, then at full
+# resolution once it is released or idle.
+#
+
+# evaluate coarsely while dragging
+progressive = True
+
+coarse_points = {
+    sym.SymbolPlot: 25,
+    sym.SymbolParametricPlot: 25,
+    sym.SymbolPlot3D: 12,
+    sym.SymbolDensityPlot: 15,
+    sym.SymbolContourPlot: 15,
+}
+
+
+# target with its PlotPoints and MaxRecursion options lowered as above,
+# or None if it isn't a call to one of the plotting functions
+def coarse_target(target):
+    points = coarse_points.get(getattr(target, "head", None))
+    if points is None:
+        return None
+    def option(e):
+        if getattr(e, "head", None) is sym.SymbolRule and len(e.elements) == 2:
+            return e.elements[0]
+    elements = []
+    for e in target.elements:
+        if option(e) is sym.SymbolPlotPoints:
+            given = e.elements[1].to_python()
+            given = given if isinstance(given, (list, tuple)) else [given]
+            if given and all(isinstance(n, int) and not isinstance(n, bool) for n in given):
+                points = min(points, *given)
+        elif option(e) is not sym.SymbolMaxRecursion:
+            elements.append(e)
+    return core.Expression(
+        target.head, *elements,
+        core.Expression(sym.SymbolRule, sym.SymbolPlotPoints, core.Integer(points)),
+        core.Expression(sym.SymbolRule, sym.SymbolMaxRecursion, core.Integer(0)),
+    )
+
+
+#
+# Cache of Manipulate results by slider position. Sliders snap to a grid of
+# steps, so dragging back and forth revisits the same positions, which we can
+# then show without evaluating. While the user is idle we also evaluate the
+# neighboring steps of the current position, as idle jobs of the Manipulate's
+# ui.UpdateScheduler, so the next step in any direction is likely to be ready
+# too. Moving a slider aborts that, since by then the user has moved on.
+#
+
+# limits per Manipulate: number of results, and approximate bytes of figure arrays
+cache_size = 64
+cache_bytes = 256 << 20
+
+# evaluate neighboring steps while idle
+prefetch = True
+
+
+# approximate size of a layout: the numpy arrays in its figure, if it has one
+def layout_bytes(layout):
+    figure = getattr(layout, "object", None)
+    if not isinstance(figure, go.Figure):
+        return 0
+    arrays = ("x", "y", "z", "i", "j", "k", "intensity", "surfacecolor", "vertexcolor", "facecolor")
+    return sum(
+        getattr(trace[name], "nbytes", 0)
+        for trace in figure.data for name in arrays if name in trace
+    )
+
+
+class ResultCache:
+
+    """
+    LRU cache of layouts by slider position for one Manipulate, computed
+    by compute(values), with prefetching of the neighboring positions
+    """
+
+    def __init__(self, compute, sliders):
+        self.compute = compute
+        self.sliders = sliders
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.prefetched = self.evictions = self.bytes = 0
+
+    # slider positions as step numbers, so that nearby float values are the same key
+    def key(self, values):
+        return tuple(round((v - s.lo) / s.step) if s.step else v for s, v in zip(self.sliders, values))
+
+    def values(self, key):
+        return [s.lo + k * s.step if s.step else k for s, k in zip(self.sliders, key)]
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                hits = self.hits, misses = self.misses, prefetched = self.prefetched,
+                evictions = self.evictions, entries = len(self.cache), bytes = self.bytes,
+            )
+
+    def store(self, key, layout):
+        with self.lock:
+            if key in self.cache:
+                return
+            size = layout_bytes(layout)
+            self.cache[key] = (layout, size)
+            self.bytes += size
+            while len(self.cache) > 1 and (len(self.cache) > cache_size or self.bytes > cache_bytes):
+                _, (_, size) = self.cache.popitem(last=False)
+                self.bytes -= size
+                self.evictions += 1
+
+    # the layout for slider values, from the cache or computed. A coarse
+    # layout is computed by compute(values, coarse=True) if we don't have
+    # the full one, and isn't cached. Nor is a layout computed while
+    # aborted() became true, which may be partial.
+    def get(self, values, coarse=False, aborted=None):
+        key = self.key(values)
+        with self.lock:
+            hit = self.cache.get(key)
+            if hit is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if hit is not None:
+            return hit[0]
+        if coarse:
+            return self.compute(values, coarse=True)
+        layout = self.compute(values)
+        if layout is None or aborted is not None and aborted():
+            return None
+        self.store(key, layout)
+        return layout
+
+    # jobs job(aborted) for ui.UpdateScheduler to run while idle, each computing
+    # a neighbor of the position values that we don't have yet
+    def prefetch(self, values):
+        key = self.key(values)
+        for i, s in enumerate(self.sliders):
+            for d in (1, -1):
+                neighbor = key[:i] + (key[i] + d,) + key[i+1:]
+                if not s.step or not 0 <= neighbor[i] * s.step <= s.hi - s.lo + s.step / 2:
+                    continue
+                with self.lock:
+                    if neighbor in self.cache:
+                        continue
+                def job(aborted, neighbor=neighbor):
+                    with util.Timer("prefetch"):
+                        layout = self.compute(self.values(neighbor))
+                    if layout is not None and not aborted():
+                        self.store(neighbor, layout)
+                        with self.lock:
+                            self.prefetched += 1
+                yield job
+
+
 #
 # given a ManipulateBox Expression, compute a layout
 #
@@ -91,23 +252,42 @@ def layout_ManipulateBox(fe, manipulate_expr, layout_options):
 
     # compute a layout for an expr given a set of values
     # this is the callback for this Manipulate to update the target with new values
-    def eval_and_layout(values):
+    # uses the compiled kernel if we have one, otherwise does a full evaluation,
+    # of the coarse target if requested and we have one
+    kernel = None
+    coarse_expr = coarse_target(target_expr) if progressive else None
+    def eval_and_layout(values, coarse=False):
+        if kernel:
+            with util.Timer("kernel"):
+                layout = kernel(values)
+            if layout is not None:
+                return layout
         # TODO: always Global?
         # TODO: always Real?
         # TODO: best order for replace_vars and eval?
         values = {s.name: a for s, a in zip(sliders, values)}
-        with util.Timer("replace and eval"):
-            expr = target_expr.replace_vars({"Global`"+n: core.Real(v) for n, v in values.items()})
-            expr = expr.evaluate(fe.session.evaluation)
-        with util.Timer("layout"):
-            layout = m3d.layout.expression_to_layout(fe, expr)
+        with util.evaluation_lock(fe.session):
+            with util.Timer("replace and eval"):
+                expr = coarse_expr if coarse and coarse_expr is not None else target_expr
+                expr = expr.replace_vars({"Global`"+n: core.Real(v) for n, v in values.items()})
+                expr = expr.evaluate(fe.session.evaluation)
+            with util.Timer("layout"):
+                layout = m3d.layout.expression_to_layout(fe, expr)
         return layout
 
     # compute the layout for the plot
     init_values = [s.init for s in sliders]
     init_target_layout = eval_and_layout(init_values)
-    layout = m3d.ui.manipulate(init_target_layout, sliders, eval_and_layout)
-        
+    kernel = m3d.kernel.compiler(target_expr, [s.name for s in sliders], init_values, init_target_layout)
+
+    # revisited and prefetched slider positions come from the cache;
+    # without a coarse target every evaluation is full and can be cached
+    cache = ResultCache(eval_and_layout, sliders)
+    get = cache.get if coarse_expr is not None else lambda values, coarse=False, aborted=None: cache.get(values, aborted=aborted)
+    idle = cache.prefetch if prefetch else None
+    layout = m3d.ui.manipulate(init_target_layout, sliders, get, idle)
+    layout._m3d_cache = cache
+
     return layout
 
 
@@ -4,15 +4,152 @@ import plotly.graph_objects as go
 import cairosvg
 import base64
 import io
+from collections import namedtuple
 
 from m3d import core, sym, util
 
 
+# Rasterized images are sized to cover their share of the figure at this many
+# image pixels per css pixel, to look sharp on high-dpi displays,
+# but no more than max_raster_size pixels on a side
+device_pixel_ratio = 2
+max_raster_size = 2048
+
+# Triangles are rasterized in chunks filling about this many pixels
+raster_chunk = 1 << 22
+
+
+# An (ny, nx, 4) uint8 rgba image with the center of pixel 0, 0 at x0y0
+# and pixel spacing dxdy, as produced by the mesh2d functions
+Raster = namedtuple("Raster", ["img", "x0y0", "dxdy"])
+
+
+# Encode an rgba image as a png data uri for go.Image(source=...).
+# Passing z instead sends every pixel as a json int, which is many times
+# larger and slower for the browser to parse.
+@util.Timer("png_source")
+def png_source(img):
+    ok, png = cv2.imencode(".png", cv2.cvtColor(img, cv2.COLOR_RGBA2BGRA))
+    return "data:image/png;base64," + base64.b64encode(png).decode("ascii")
+
+
+# For polys that form a regular grid as found by render.find_grid, e.g. DensityPlot,
+# emit one image pixel per grid cell colored with the average of its corner colors,
+# with no rasterization. Cells missing from the grid are transparent.
+# go.Image requires uniform pixel spacing, so returns None if the grid isn't uniform.
+@util.Timer("mesh2d_grid")
+def mesh2d_grid(vertices, colors, xs, ys, index):
+
+    # check for uniform spacing
+    dx, dy = np.diff(xs), np.diff(ys)
+    if not (np.allclose(dx, dx[0], rtol=1e-6, atol=0) and np.allclose(dy, dy[0], rtol=1e-6, atol=0)):
+        return None
+    dx, dy = (xs[-1] - xs[0]) / (len(xs) - 1), (ys[-1] - ys[0]) / (len(ys) - 1)
+
+    # average corner colors for each cell; missing corners are nan
+    corners = np.where((index >= 0)[...,None], colors[index], np.nan)
+    cells = (corners[:-1,:-1] + corners[:-1,1:] + corners[1:,:-1] + corners[1:,1:]) / 4
+    missing = np.isnan(cells).any(axis=-1)
+
+    img = np.round(np.nan_to_num(cells) * 255).astype(np.uint8)
+    img[missing] = 0
+
+    # pixel centers are the cell centers
+    return Raster(img, (xs[0] + dx/2, ys[0] + dy/2), (dx, dy))
+
+
+# Rasterize triangles, given as an (n, 3) array of indexes into vertices, into an
+# nx by ny rgba image covering the extent of the vertices. Each triangle takes
+# the color of its first vertex, or color (rgb or rgba) if colors is None,
+# and later triangles paint over earlier ones. Pixels are filled if their centers
+# are inside the triangle. This is a scanline fill done in bulk: we compute the
+# span of pixels covered by each row of each triangle, then fill all the spans,
+# so there is no per-triangle Python loop.
+#
+# For 200x200 grid (80,000 triangles) from DensityPlot:
+#     mesh2d_opencv below, one cv2.fillPoly per poly: ~90 ms at 200x200
+#     this: ~65 ms at 200x200, ~130 ms at 800x800
+# cv2.fillPoly can take many polys at once, but they are filled even-odd
+# as a single shape, which leaves holes where polys overlap.
+@util.Timer("mesh2d_raster")
+def mesh2d_raster(vertices, tris, colors, nx, ny, color=None):
+
+    # scale vertices so that pixel centers are at integer coordinates
+    xy = vertices[:,:2]
+    lo, hi = np.nanmin(xy, axis=0), np.nanmax(xy, axis=0)
+    size = np.array([nx, ny])
+    d = np.where(hi > lo, (hi - lo) / size, 1)
+    pxy = (xy - lo) / d - 0.5
+
+    # rgba colors for each triangle, as uint8 with nan (no color) transparent
+    if colors is None:
+        rgba = np.ones(4)
+        rgba[:len(color)] = color
+        tri_colors = np.broadcast_to(rgba, (len(tris), 4))
+    else:
+        tri_colors = colors[tris[:,0]]
+        if tri_colors.shape[1] == 3:
+            tri_colors = np.hstack([tri_colors, np.ones((len(tri_colors), 1))])
+    tri_colors = np.round(np.nan_to_num(tri_colors, nan=0) * 255).astype(np.uint8)
+
+    # each rgba pixel as a single uint32 for faster filling
+    tri_colors = np.ascontiguousarray(tri_colors).view(np.uint32).reshape(-1)
+
+    # triangle corners, and the rows of pixel centers they cover
+    corners = pxy[tris]
+    keep = np.isfinite(corners).all(axis=(1,2))
+    if not keep.all():
+        corners, tri_colors = corners[keep], tri_colors[keep]
+    row_lo = np.clip(np.ceil(corners[...,1].min(axis=1)), 0, ny).astype(np.int64)
+    row_hi = np.clip(np.floor(corners[...,1].max(axis=1)) + 1, 0, ny).astype(np.int64)
+
+    # edge function coefficients a x + b y + c, oriented so that inside is positive
+    x, y = corners[...,0], corners[...,1]
+    x1, y1 = np.roll(x, -1, axis=1), np.roll(y, -1, axis=1)
+    a, b = y - y1, x1 - x
+    c = x * y1 - x1 * y
+    sign = np.sign(c.sum(axis=1))[:,None]
+    a, b, c = a * sign, b * sign, c * sign
+    nrows = np.where(sign[:,0] != 0, row_hi - row_lo, 0)
+
+    # for each row of each triangle, the span of columns inside all three edges
+    t = np.repeat(np.arange(len(nrows)), nrows)
+    row = row_lo[t] + np.arange(len(t)) - np.repeat(np.cumsum(nrows) - nrows, nrows)
+    left = np.zeros(len(t))
+    right = np.full(len(t), nx - 1.0)
+    eps = 1e-9
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for e in range(3):
+            ae, value = a[t,e], b[t,e] * row + c[t,e]
+            bound = -value / ae
+            left = np.where(ae > 0, np.maximum(left, bound - eps), left)
+            right = np.where(ae < 0, np.minimum(right, bound + eps), right)
+            right = np.where((ae == 0) & (value < -eps), -1, right)
+    left = np.ceil(left).astype(np.int64)
+    widths = np.maximum(np.floor(right).astype(np.int64) - left + 1, 0)
+    starts = row * nx + left
+
+    img = np.zeros((ny, nx, 4), dtype=np.uint8)
+    flat = img.view(np.uint32).reshape(-1)
+
+    # fill spans in chunks so that the per-pixel arrays stay a reasonable size;
+    # later triangles win where assignments overlap
+    ends = np.cumsum(widths)
+    bounds = np.searchsorted(ends, np.arange(raster_chunk, ends[-1] if len(ends) else 0, raster_chunk))
+    bounds = [0, *bounds, len(widths)]
+    for i0, i1 in zip(bounds[:-1], bounds[1:]):
+        n = widths[i0:i1]
+        k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        flat[np.repeat(starts[i0:i1], n) + k] = tri_colors[np.repeat(t[i0:i1], n)]
+
+    return Raster(img, lo + d/2, d)
+
+
 @util.Timer("mesh2d_opencv")
 def mesh2d_opencv(vertices, polys, colors, nx=200, ny=200):
 
     # images of requested size
-    img = np.full((nx,ny,3), 255, dtype=np.uint8)
+    img = np.zeros((ny,nx,4), dtype=np.uint8)
 
     # scale vertices to nx, ny
     data_xs, data_ys = vertices[...,0], vertices[...,1]
@@ -24,7 +161,7 @@ def mesh2d_opencv(vertices, polys, colors, nx=200, ny=200):
     
     # TODO: average poly color instead of vertex 0?
     colors = colors[polys[:,0],:] * 255
-    colors[np.isnan(colors)] = 255
+    colors[np.isnan(colors)] = 0
 
     # expand polys from indices to coordinates
     # seems not to like fp coordinates though
@@ -33,25 +170,9 @@ def mesh2d_opencv(vertices, polys, colors, nx=200, ny=200):
 
     # render the polys
     for poly, color in zip(polys, colors):
-        cv2.fillPoly(img, [poly], color)
-
-    # go.Image doesn't have x, y arrays (unlike other graphic objects)
-    # so we monkey-patch them in because we use it to compute data
-    # range from all the graphic objects later on
-    class Im(go.Image):
-        def __init__(self, x, y, *args, **kwargs):
-            super().__init__(*args, **kwargs)
-            object.__setattr__(self, "x", x)
-            object.__setattr__(self, "y", y)
-            
-    # construct our mesh to add to the figure
-    mesh = Im(
-        z=img,
-        x0=x_min, dx=(x_max-x_min)/nx, x=data_xs,
-        y0=y_min, dy=(y_max-y_min)/ny, y=data_ys,
-    )
+        cv2.fillPoly(img, [poly], color.tolist())
 
-    return mesh
+    return Raster(img, (x_min, y_min), ((x_max-x_min)/nx, (y_max-y_min)/ny))
 
 
 
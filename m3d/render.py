@@ -8,6 +8,92 @@ import copy
 from m3d import core, sym, util
 import m3d.ticker
 import m3d.mesh2d
+import m3d.transport
+import m3d.decimate
+import m3d.gradient
+import m3d.simplify
+import m3d.triangulate
+from m3d.consumer import Ragged, Styles, ragged
+
+
+# tolerance for welding vertices in need_vertices, relative to the extent of the data;
+# None disables welding
+weld_tolerance = 1e-9
+
+# most pairs of shapes overlapping in x that last_overlapping checks in full,
+# and how many of them at a time
+max_overlap_pairs = 1 << 24
+overlap_chunk = 1 << 20
+
+# welded 3d meshes whose faces meet at more than this many degrees anywhere keep
+# separate vertices per face, since Mesh3d would smooth the shading across them
+crease_angle = 30
+
+
+# Merge vertices that coincide to within tolerance (relative to the extent of the data)
+# and have the same color. Quantized coordinates and colors are hashed to a single
+# integer key, so we can use a fast 1-d unique; in the unlikely event of a hash
+# collision we fall back to an exact unique on the rows of keys.
+# Vertices with non-finite coordinates are never merged.
+# Returns the merged vertices and colors, and for each original vertex
+# the index of the merged vertex that replaces it.
+def weld_vertices(vertices, colors, tolerance):
+    finite = np.isfinite(vertices).all(axis=1)
+    if not finite.any():
+        return vertices, colors, np.arange(len(vertices))
+    lo = vertices[finite].min(axis=0)
+    hi = vertices[finite].max(axis=0)
+    step = max((hi - lo).max(), np.finfo(float).tiny) * tolerance
+    keys = [np.where(finite[:,None], np.round((vertices - lo) / step), 0).astype(np.int64)]
+    keys.append(np.where(finite, 0, np.arange(1, len(vertices) + 1))[:,None])
+    if colors is not None:
+        keys.append(np.round(np.nan_to_num(colors, nan=-1) * 65535).astype(np.int64))
+    keys = np.ascontiguousarray(np.hstack(keys))
+    hashed = np.zeros(len(keys), dtype=np.uint64)
+    for i, column in enumerate(keys.T.astype(np.uint64)):
+        hashed = (hashed ^ column) * np.uint64(0x100000001b3 + 2 * i)
+    _, first, inverse = np.unique(hashed, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    if not (keys[first][inverse] == keys).all():
+        rows = keys.view(np.dtype((np.void, keys.dtype.itemsize * keys.shape[1]))).ravel()
+        _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+    colors = colors[first] if colors is not None else None
+    return vertices[first], colors, inverse.reshape(-1)
+
+
+# Traces and layouts are built as plain dicts, which go.Figure takes as is
+# with _validate=False, skipping the graph_objects validators that check and
+# copy every array. Set validate to check everything, e.g. when debugging.
+validate = False
+
+# 2d point and line traces with more than this many points are drawn with WebGL
+# (Scattergl) instead of SVG, which bogs down beyond about 50k points; None for never.
+# Overridden for individual graphics by Method -> {"WebGL" -> True|False}.
+# See exp/bench_webgl.py for finding the crossover.
+webgl_threshold = 50000
+
+# A trace dict of the given plotly type, leaving out properties that are None
+def trace(type, **props):
+    return dict(type=type, **{name: value for name, value in props.items() if value is not None})
+
+
+# Whether some two triangles of tris that share an edge meet at more than angle
+# degrees, i.e. the mesh has sharp edges, like a cube, rather than being a smooth
+# surface. Inconsistently wound neighbors count as meeting at a sharp angle.
+def creased(vertices, tris, angle):
+    corners = vertices[tris]
+    normals = np.cross(corners[:,1] - corners[:,0], corners[:,2] - corners[:,0])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        normals /= la.norm(normals, axis=1)[:,None]
+    edges = np.sort(np.concatenate([tris[:,[0,1]], tris[:,[1,2]], tris[:,[2,0]]]), axis=1)
+    keys = edges[:,0] * np.int64(len(vertices)) + edges[:,1]
+    owners = np.tile(np.arange(len(tris)), 3)
+    order = np.argsort(keys, kind="stable")
+    keys, owners = keys[order], owners[order]
+    shared = keys[1:] == keys[:-1]
+    a, b = owners[:-1][shared], owners[1:][shared]
+    cos = (normals[a] * normals[b]).sum(axis=1)
+    return bool((cos < np.cos(np.radians(angle))).any())
 
 
 # TODO: move to consumer
@@ -17,16 +103,181 @@ import m3d.mesh2d
 #     vertices are point coordinates
 #     items have indexes into vertices list instead of the coordinates
 #     colors are 1-1 with vertices
-def need_vertices(vertices, items, colors):
+#     Ragged items stay Ragged, with values that are indexes
+# if weld is True, shared corners are merged (see weld_tolerance), and the
+# index of the merged vertex for each original one is returned as well
+def need_vertices(vertices, items, colors, weld=False):
+    inverse = None
     if vertices is None:
         with util.Timer("make vertices"):
-            vertices = items.reshape(-1, items.shape[-1])
+            if isinstance(items, Ragged):
+                vertices = items.values
+                items = Ragged(items.offsets, np.arange(len(vertices)))
+            else:
+                vertices = items.reshape(-1, items.shape[-1])
+                items = np.arange(len(vertices)).reshape(items.shape[:-1])
             if colors is not None:
                 colors = colors.reshape(-1, colors.shape[-1])
-            items = np.arange(len(vertices)).reshape(items.shape[:-1])
+        if weld and weld_tolerance:
+            with util.Timer("weld vertices"):
+                vertices, colors, inverse = weld_vertices(vertices, colors, weld_tolerance)
+                if isinstance(items, Ragged):
+                    items = Ragged(items.offsets, inverse[items.values])
+                else:
+                    items = inverse[items]
+    if weld:
+        return vertices, items, colors, inverse
     return vertices, items, colors
 
 
+# If polys are quads whose vertices lie on an nx by ny lattice in x and y, with
+# exactly one quad for every lattice cell whose corners are all present, return
+# (xs, ys, index): the distinct x and y coordinates, and an (ny, nx) array of a
+# vertex at each lattice point, or -1 where there is none. Otherwise return None.
+# Vertices at the same lattice point must be identical, including their colors,
+# so that unwelded inline grids are found too.
+# This is how we recognize Plot3D, DensityPlot, etc. output.
+def find_grid(vertices, polys, colors=None):
+
+    if isinstance(polys, Ragged) or polys.ndim != 2 or polys.shape[1] != 4 or len(polys) == 0:
+        return None
+
+    # lattice coordinates of each used vertex
+    used = np.flatnonzero(np.bincount(polys.reshape(-1), minlength=len(vertices)))
+    xy = vertices[used, :2]
+    if not np.isfinite(xy).all():
+        return None
+    xs, ix = np.unique(xy[:,0], return_inverse=True)
+    ys, iy = np.unique(xy[:,1], return_inverse=True)
+    nx, ny = len(xs), len(ys)
+    if nx < 2 or ny < 2:
+        return None
+    lattice = np.full(len(vertices), -1)
+    lattice[used] = iy.reshape(-1) * nx + ix.reshape(-1)
+    index = np.full((ny, nx), -1)
+    index.reshape(-1)[lattice[used]] = used
+
+    # coincident vertices must agree
+    same = index.reshape(-1)[lattice[used]]
+    if not (np.array_equal(vertices[used], vertices[same], equal_nan=True) and
+            (colors is None or np.array_equal(colors[used], colors[same], equal_nan=True))):
+        return None
+
+    # each quad must span one lattice cell
+    corners = np.sort(lattice[polys], axis=1)
+    cells = corners[:,0]
+    expected = cells[:,None] + np.array([0, 1, nx, nx + 1])
+    if not (corners == expected).all() or (cells % nx == nx - 1).any():
+        return None
+
+    # ... and every cell with all corners present must have exactly one quad
+    present = index >= 0
+    full = present[:-1,:-1] & present[:-1,1:] & present[1:,:-1] & present[1:,1:]
+    if np.bincount(cells).max() > 1 or np.count_nonzero(full) != len(cells):
+        return None
+
+    return xs, ys, index
+
+
+# For each of the bounding boxes, where boxes is an (n, 2, 2) array of [lo, hi]
+# corners, the index of the last earlier box that it overlaps, or -1. Boxes that
+# only touch don't overlap. A sort and sweep in x gives the pairs of boxes that
+# overlap in x, which we then check in full, overlap_chunk pairs at a time so
+# as not to need arrays of all of them. If there are more than
+# max_overlap_pairs of those we say instead that each box that overlaps another
+# in x overlaps the one before it, which is safe for _add_shapes, just splits
+# more than it needs to.
+def last_overlapping(boxes):
+    n = len(boxes)
+    result = np.full(n, -1)
+    if n < 2:
+        return result
+    order = np.argsort(boxes[:,0,0], kind="stable")
+    lo, hi = boxes[order,0,0], boxes[order,1,0]
+    counts = np.searchsorted(lo, hi, side="left") - np.arange(1, n + 1)
+    counts = np.where(np.isfinite(lo) & np.isfinite(hi), np.maximum(counts, 0), 0)
+    total = counts.sum()
+    if total > max_overlap_pairs:
+        before = np.concatenate([[-np.inf], np.fmax.accumulate(hi)[:-1]])
+        candidate = np.zeros(n, dtype=bool)
+        candidate[order] = (lo < before) | (counts > 0)
+        candidate[0] = False
+        result[candidate] = np.flatnonzero(candidate) - 1
+        return result
+    ends = np.cumsum(counts)
+    bounds = np.unique([0, *np.searchsorted(ends, np.arange(overlap_chunk, total, overlap_chunk)), n])
+    for p0, p1 in zip(bounds[:-1], bounds[1:]):
+        c = counts[p0:p1]
+        a = np.repeat(np.arange(p0, p1), c)
+        b = a + 1 + np.arange(len(a)) - np.repeat(np.cumsum(c) - c, c)
+        i, j = order[a], order[b]
+        hit = np.ones(len(a), dtype=bool)
+        for axis in range(boxes.shape[2]):
+            hit &= (boxes[i,0,axis] < boxes[j,1,axis]) & (boxes[j,0,axis] < boxes[i,1,axis])
+        i, j = i[hit], j[hit]
+        np.maximum.at(result, np.maximum(i, j), np.minimum(i, j))
+    return result
+
+
+# Normalize a batch of items to either a uniform array or a Ragged batch
+def as_batch(items):
+    if isinstance(items, (list,tuple)) and not isinstance(items, Ragged):
+        try:
+            items = np.array(items)
+        except ValueError:
+            return ragged(items)
+    if isinstance(items, np.ndarray) and items.dtype == object:
+        return ragged(items)
+    return items
+
+
+# Select the items of a batch where mask is True
+def select(items, mask):
+    if isinstance(items, Ragged):
+        lengths = np.diff(items.offsets)
+        offsets = np.zeros(np.count_nonzero(mask) + 1, dtype=items.offsets.dtype)
+        np.cumsum(lengths[mask], out=offsets[1:])
+        return Ragged(offsets, items.values[np.repeat(mask, lengths)])
+    return items[mask]
+
+
+# Concatenate lines, separating them with np.nan so they are
+# drawn as multiple line segments with a break between them.
+# We use nan instead of None so we can use nanmin and nanmax on the array.
+# lines is either a uniform (n, l, d) array, a Ragged batch, or a list of (l_i, d)
+# arrays; if vertices is not None the lines hold indexes into vertices.
+# Returns a single (m, d) array, built without looping over the lines.
+def join_lines(vertices, lines):
+
+    if vertices is not None:
+        vertices = np.asarray(vertices)
+    lines = as_batch(lines)
+
+    # uniform batch: append a nan vertex to every line and drop the last one
+    uniform_ndim = 2 if vertices is not None else 3
+    if isinstance(lines, np.ndarray) and lines.dtype != object and lines.ndim == uniform_ndim:
+        if vertices is not None:
+            lines = vertices[lines]
+        n, l, dim = lines.shape
+        joined = np.full((n, l + 1, dim), np.nan)
+        joined[:, :l] = lines
+        return joined.reshape((-1, dim))[:-1]
+
+    # ragged batch: each vertex moves down by the number of separators before it
+    if not isinstance(lines, Ragged):
+        lines = ragged(lines)
+    offsets, values = lines
+    if vertices is not None:
+        values = vertices[values]
+    n = len(offsets) - 1
+    if n <= 0:
+        return np.empty((0, values.shape[-1]))
+    line_ids = np.repeat(np.arange(n), np.diff(offsets))
+    joined = np.full((len(values) + n - 1, values.shape[-1]), np.nan)
+    joined[np.arange(len(values)) + line_ids] = values
+    return joined
+
+
 def to_color_str(rgb):
     # rgb need to be int 0-255, opacity needs to be float 0.0-1.0
     args = ','.join(str(int(c*255)) for c in rgb[0:3])
@@ -36,6 +287,12 @@ def to_color_str(rgb):
         color = f"rgba({args},{rgb[3]:.2f})"
     return color
 
+# Color strings for an (n, 4) array of colors, converting each distinct color only once
+def to_color_strs(rgbas):
+    unique, inverse = np.unique(rgbas, axis=0, return_inverse=True)
+    strs = np.array([to_color_str(rgba) for rgba in unique], dtype=object)
+    return strs[inverse.reshape(-1)]
+
 class Style:
 
     # color applies to points, lines, polys
@@ -66,6 +323,14 @@ class FigureBuilder:
         self.data = []
         self.opts = options
         self.has_image = False
+
+        # running bounding box of the data, updated by each add_*
+        self.data_lo = np.full(dim, np.nan)
+        self.data_hi = np.full(dim, np.nan)
+
+        # shapes waiting to be batched into fill traces, see _add_shapes
+        self.shapes = []
+        self.shape_batches = {}
         
         self.style = Style()
 
@@ -93,25 +358,91 @@ class FigureBuilder:
         else:
             self.style.thickness = thickness
 
+    # Add a trace. Batched shapes come first to keep the drawing order.
+    def _append(self, trace):
+        self._flush_shapes()
+        self.data.append(trace)
+
+    # Plotly trace type for 2d points or lines with n points
+    def _scatter_type(self, n):
+        webgl = self.opts.method.get("WebGL")
+        if webgl is None:
+            webgl = webgl_threshold is not None and n > webgl_threshold
+        return "scattergl" if webgl else "scatter"
+
+    # Grow the bounding box of the data to include lo and hi, per-axis
+    # bounds that may be nan. fmin and fmax ignore nans.
+    def _extend(self, lo, hi):
+        np.fmin(self.data_lo, lo[:self.dim], out=self.data_lo)
+        np.fmax(self.data_hi, hi[:self.dim], out=self.data_hi)
+
+    # Grow the bounding box of the data to include an (n, d) array of points
+    def _extend_points(self, points):
+        if len(points):
+            self._extend(np.fmin.reduce(points, axis=0), np.fmax.reduce(points, axis=0))
+
+    # Styles from a coalescing GraphicsConsumer record per-primitive colors and
+    # thicknesses, with nan meaning the current style; resolve them to (n, 4) rgba
+    # colors and (n,) thicknesses
+    def _resolve_styles(self, styles):
+        rgbas = styles.colors.copy()
+        rgba = np.ones(4)
+        rgba[:len(self.style.color)] = self.style.color
+        rgbas[np.isnan(rgbas[:,0])] = rgba
+        thickness = np.where(np.isnan(styles.thickness), self.style.thickness, styles.thickness)
+        return rgbas, thickness
+
+    # Where a single trace can't carry per-primitive styles, call add once for each
+    # distinct style, with the current style set to match. If by_color is False only
+    # thicknesses are grouped, and add gets the Styles for each group.
+    def _add_by_style(self, add, vertices, items, colors, styles, by_color=True):
+        rgbas, thickness = self._resolve_styles(styles)
+        keys = np.column_stack([rgbas, thickness]) if by_color else thickness[:, None]
+        unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        items = as_batch(items)
+        saved = self.style
+        for i, key in enumerate(unique):
+            mask = inverse == i
+            self.style = copy.copy(saved)
+            self.style.thickness = float(key[-1])
+            if by_color:
+                self.style.color = key[:4]
+                add(vertices, select(items, mask), colors)
+            else:
+                add(vertices, select(items, mask), colors, Styles(rgbas[mask], thickness[mask]))
+        self.style = saved
+
     util.Timer("add_points")
-    def add_points(self, vertices, points, colors):
+    def add_points(self, vertices, points, colors, styles=None):
+        if isinstance(points, Ragged):
+            points = points.values
         if vertices is not None:
-            lines = vertices[lines]
+            points = vertices[points]
+        points = points.reshape((-1, points.shape[-1]))
+
+        # per-marker colors if coalescing styles
+        if styles is not None:
+            color = to_color_strs(self._resolve_styles(styles)[0])
+        else:
+            color = self.style.color_str
+
         if self.dim == 2:
-            scatter_points = go.Scatter(
+            scatter_points = trace(self._scatter_type(len(points)),
                 x = points[:,0], y = points[:,1],
-                mode='markers', marker=dict(color=self.style.color_str, size=8)
+                mode='markers', marker=dict(color=color, size=8)
             )
         elif self.dim == 3:
             # TODO: not tested
-            scatter_points = go.Scatter3D(
+            scatter_points = trace("scatter3d",
                 x = points[:,0], y = points[:,1], z = points[:,2],
-                mode='markers', marker=dict(color=self.style.color_str, size=8)
+                mode='markers', marker=dict(color=color, size=8)
             )
-        self.data.append(scatter_points)
+        self._append(scatter_points)
+        self._extend_points(points)
 
     util.Timer("add_lines")
-    def add_lines(self, vertices, lines, colors):
+    def add_lines(self, vertices, lines, colors, styles=None):
 
         """
         # short-circuit em
@@ -120,73 +451,134 @@ class FigureBuilder:
             return
         """
 
-        if vertices is not None:
-            lines = vertices[lines]
+        # if coalescing styles, 2d lines need one trace per style;
+        # 3d lines support per-vertex colors, so need one trace per thickness
+        color, width = self.style.color_str, self.style.thickness
+        if styles is not None:
+            rgbas, thickness = self._resolve_styles(styles)
+            if self.dim == 2 or not np.all(thickness == thickness[0]):
+                self._add_by_style(self.add_lines, vertices, lines, colors, styles, by_color=self.dim==2)
+                return
+            width = float(thickness[0])
+            # per-vertex colors, found by joining the index of the line each vertex belongs to
+            lines = as_batch(lines)
+            if isinstance(lines, Ragged):
+                n = len(lines.offsets) - 1
+                ids = Ragged(lines.offsets, np.repeat(np.arange(n, dtype=float), np.diff(lines.offsets))[:, None])
+            else:
+                ids = np.broadcast_to(np.arange(len(lines), dtype=float)[:, None, None], lines.shape[:2] + (1,))
+            ids = np.nan_to_num(join_lines(None, ids)[:,0]).astype(int)
+            color = to_color_strs(rgbas)[ids]
 
-        # Concatenate lines, separating them with np.nan so they are
-        # drawn as multiple line segments with a break between them.
-        # We use nan instead of None so we can use nanmin and nanmax on the array.
-        # also we can't rely on self.dim b/c classic density plot sends dim 3 mesh
+        # we can't rely on self.dim b/c classic density plot sends dim 3 mesh
         # TODO: track down why sometimes it's not coming through as an array
-        dim = len(lines[0][0])
-        single = [lines[0]]
-        for line in lines[1:]:
-            single.append([[np.nan] * dim])
-            single.append(line)
-        lines = np.vstack(single).reshape((-1, dim))
+        with util.Timer("join lines"):
+            lines = join_lines(vertices, lines)
+
+        # thin long 2d lines down to what can be seen at our resolution
+        if self.dim == 2:
+            decimate = self.opts.method.get("Decimate")
+            if decimate if decimate is not None else m3d.decimate.enabled:
+                lines = m3d.decimate.decimate(lines, self._raster_size(lines)[0])
 
         if self.dim == 2:
-            scatter_line = go.Scatter(
+            scatter_line = trace(self._scatter_type(len(lines)),
                 x = lines[:,0], y = lines[:,1],
-                mode='lines', line=dict(color=self.style.color_str, width=self.style.thickness),
+                mode='lines', line=dict(color=color, width=width),
                 showlegend=False
             )
         elif self.dim == 3:
-            scatter_line = go.Scatter3d(
+            scatter_line = trace("scatter3d",
                 x = lines[:,0], y = lines[:,1], z = lines[:,2],
-                mode='lines', line=dict(color=self.style.color_str, width=self.style.thickness),
+                mode='lines', line=dict(color=color, width=width),
                 showlegend=False
             )
-        self.data.append(scatter_line)
+        self._append(scatter_line)
+        self._extend_points(lines)
 
     # TODO: move triangulation inside?
     util.Timer("add_mesh")
-    def add_polys(self, vertices, polys, colors):
+    def add_polys(self, vertices, polys, colors, styles=None):
+
+        # vertex colors take precedence over coalesced styles
+        if colors is not None:
+            styles = None
+
+        # in 2d one image or shape per style
+        if styles is not None and self.dim == 2:
+            self._add_by_style(self.add_polys, vertices, polys, colors, styles)
+            return
 
         if self.dim==3:
 
-            vertices, polys, colors = need_vertices(vertices, polys, colors)
+            # inline polygons repeat shared corners, which we weld; we keep the
+            # unwelded faces in case the mesh turns out to have sharp edges
+            faces = need_vertices(vertices, polys, colors)
+            vertices, polys, colors, welded = need_vertices(vertices, polys, colors, weld=True)
 
-            # TODO: only works well for nearly planar convex polys
-            with util.Timer("triangulate"):
-                ijks = []
-                ngon = polys.shape[1]
-                for i in range(1, ngon-1):
-                    inx = [0, i, i+1]
-                    tris = polys[:, inx]
-                    ijks.extend(tris)
-                ijks = np.array(ijks)
-
-            # seems to be good default lighting
-            lighting = dict(
-                ambient = 0.5,
-                roughness = 0.5,
-                diffuse = 1.0,
-                specular = 0.8,
-                fresnel = 0.1
-            )
+            # vertex colors along a gradient, e.g. from a ColorFunction,
+            # can be sent as one intensity per vertex and a colorscale
+            gradient = None
+            if colors is not None:
+                intensity = self.opts.method.get("Intensity")
+                if intensity if intensity is not None else m3d.gradient.enabled:
+                    gradient = m3d.gradient.fit(colors)
+
+            # a regular grid can be sent much more compactly as a go.Surface
+            if styles is None and (colors is None or gradient is not None):
+                with util.Timer("find grid"):
+                    grid = find_grid(vertices, polys, colors)
+                if grid is not None:
+                    self._add_surface(vertices, *grid, gradient)
+                    return
+
+            ijks = m3d.triangulate.triangulate(vertices, polys)
+            owners = m3d.triangulate.triangle_owners(polys)
+
+            # faceted solids get a vertex per face corner so their edges stay crisp
+            if welded is not None and crease_angle is not None:
+                with util.Timer("creased"):
+                    sharp = creased(vertices, ijks, crease_angle)
+                if sharp:
+                    vertices, polys, colors = faces
+                    ijks = m3d.triangulate.triangulate(vertices, polys)
+                    if gradient is not None:
+                        gradient = gradient._replace(intensity=gradient.intensity[welded])
+
+            # reduce large meshes to about what the figure can show;
+            # intensities are averaged rather than colors so they stay on the gradient
+            simplify = self.opts.method.get("Simplify")
+            if simplify is None:
+                simplify = m3d.simplify.enabled and not hasattr(self.fe, "test_image")
+            if simplify:
+                budget = m3d.simplify.budget(self.opts.image_size)
+                values = gradient.intensity[:,None] if gradient is not None else colors
+                vertices, ijks, values, keep = m3d.simplify.simplify(vertices, ijks, values, budget)
+                owners = owners[keep]
+                if gradient is not None:
+                    gradient = gradient._replace(intensity=values[:,0])
+                else:
+                    colors = values
+
+            # per-face colors if coalescing styles
+            facecolor = None
+            if styles is not None:
+                facecolor = to_color_strs(self._resolve_styles(styles)[0])[owners]
 
-            mesh = go.Mesh3d(
+            mesh = trace("mesh3d",
                 x=vertices[:,0], y=vertices[:,1], z=vertices[:,2],
                 i=ijks[:,0], j=ijks[:,1], k=ijks[:,2],
-                lighting = lighting,
+                lighting = self.lighting,
                 lightposition = dict(x=10000, y=10000, z=10000),
                 color = self.style.color_str,
-                vertexcolor = colors,
-                hoverinfo = "none"
+                vertexcolor = colors if gradient is None else None,
+                facecolor = facecolor,
+                hovertemplate = self.hovertemplate[3],
+                **self._gradient_props(gradient, "intensity")
             )
 
-            self.data.append(mesh)
+            self._append(mesh)
+            self._extend_points(vertices)
 
         elif self.dim==2:
 
@@ -194,21 +586,24 @@ class FigureBuilder:
             # Plotly lacks something like Mesh2d so we have to find some workarounds
             #
 
+            vertices, polys, colors = need_vertices(vertices, polys, colors)
+            npolys = len(polys.offsets) - 1 if isinstance(polys, Ragged) else len(polys)
+
             # TODO: find performance crossover?
-            if len(polys) < 10:
+            if npolys < 10:
 
                 # use Scatter specifying each polygon as a marker
                 # this case is for things like plots with Fill=...
                 # that generate a single polygon or so
-                if vertices is not None:
-                    if colors is not None:
-                        colors = colors[polys[:,0],:] * 255
-                    polys = vertices[polys]
+                if isinstance(polys, Ragged):
+                    firsts = polys.values[polys.offsets[:-1]]
+                    polys = np.split(polys.values, polys.offsets[1:-1])
+                else:
+                    firsts = polys[:,0]
                 for i, poly in enumerate(polys):
-                    poly = np.array(poly)
-                    # TODO: take averagee color instead of vertex 0 color[0]
-                    color = None if colors is None else colors[i][0]
-                    self._add_shape(poly[:,0], poly[:,1], color)
+                    # TODO: take averagee color instead of vertex 0 color
+                    color = None if colors is None else colors[firsts[i]]
+                    self._add_shapes([vertices[poly][:,:2]], color)
 
             else:
 
@@ -218,11 +613,24 @@ class FigureBuilder:
                 # use mesh2d_markers
                 #mesh = mesh2d.mesh2d_markers(vertices, polys, colors) # 600 ms
 
-                # use mesh2d_opencv
-                vertices, polys, colors = need_vertices(vertices, polys, colors)
-                mesh = m3d.mesh2d.mesh2d_opencv(vertices, polys, colors, 200, 200) # 70 ms
-                self.data.append(mesh)
-                self.has_image = True
+                # a regular grid maps directly to image pixels without rasterizing
+                raster = None
+                if colors is not None:
+                    with util.Timer("find grid"):
+                        grid = find_grid(vertices, polys, colors)
+                    if grid is not None:
+                        raster = m3d.mesh2d.mesh2d_grid(vertices, colors, *grid)
+
+                # otherwise rasterize at the resolution we'll be displayed at
+                # fan triangulation keeps vertex 0, and so the color, of each poly;
+                # order triangles by poly so that later polys paint over earlier ones
+                if raster is None:
+                    tris = m3d.triangulate.fan(polys)
+                    tris = tris[np.argsort(m3d.triangulate.triangle_owners(polys), kind="stable")]
+                    nx, ny = self._raster_size(vertices)
+                    raster = m3d.mesh2d.mesh2d_raster(vertices, tris, colors, nx, ny, self.style.color)
+
+                self._add_image(raster)
 
                 # use mesh2d_svg
                 # much too slow (>1 s)
@@ -237,81 +645,231 @@ class FigureBuilder:
                 #vertices = np.hstack([vertices, np.full(vertices.shape[0:2], 0.0)])
                 #self.add_polys(vertices, polys, colors)
 
-    def _add_shape(self, xs, ys, color=None):
+    # Add a mesh2d.Raster as a png image
+    def _add_image(self, raster):
+        img, (x0, y0), (dx, dy) = raster
+        ny, nx = img.shape[:2]
+        image = trace("image",
+            source = m3d.mesh2d.png_source(img),
+            x0 = x0, dx = dx,
+            y0 = y0, dy = dy,
+            hovertemplate = self.hovertemplate[2]
+        )
+        self._append(image)
+        self._extend(np.array([x0 - dx/2, y0 - dy/2]), np.array([x0 + (nx - 0.5) * dx, y0 + (ny - 0.5) * dy]))
+        self.has_image = True
+
+    # Pixel size for rasterizing 2d content covering vertices: its share of
+    # the figure, as far as we can tell before figure() computes the final
+    # plot range, at device resolution
+    def _raster_size(self, vertices):
+        lo, hi = np.nanmin(vertices[:,:2], axis=0), np.nanmax(vertices[:,:2], axis=0)
+        extent = np.where(hi > lo, hi - lo, 1)
+        span = np.array([
+            r[1] - r[0] if isinstance(r, list) else e
+            for r, e in zip(self.opts.plot_range, extent)
+        ])
+        width, height = self.opts.image_size
+        if not height:
+            height = width * span[1] / span[0]
+        size = np.array([width, height]) * extent / span * m3d.mesh2d.device_pixel_ratio
+        size = np.clip(np.ceil(size), 1, m3d.mesh2d.max_raster_size)
+        return int(size[0]), int(size[1])
+
+    # hover shows coordinates, by dimension; not colors, which for
+    # images from a png source aren't available, and for surfaces and
+    # meshes colored by a gradient would be intensities
+    hovertemplate = {
+        2: "x: %{x}<br>y: %{y}<extra></extra>",
+        3: "x: %{x}<br>y: %{y}<br>z: %{z}<extra></extra>",
+    }
+
+    # seems to be good default lighting
+    lighting = dict(
+        ambient = 0.5,
+        roughness = 0.5,
+        diffuse = 1.0,
+        specular = 0.8,
+        fresnel = 0.1
+    )
+
+    # Trace properties that color by the intensity of an m3d.gradient.Gradient,
+    # given as property prop ("intensity" for Mesh3d, "surfacecolor" for Surface)
+    def _gradient_props(self, gradient, prop, intensity=None):
+        if gradient is None:
+            return {}
+        return {
+            prop: gradient.intensity if intensity is None else intensity,
+            "colorscale": gradient.colorscale,
+            "cmin": 0, "cmax": 1,
+            "showscale": False,
+        }
+
+    # a surface over a regular grid found by find_grid: a z matrix plus 1-d x and y
+    # instead of explicit vertices and triangles; missing lattice points become holes.
+    # Colored by gradient if given, otherwise a single color
+    def _add_surface(self, vertices, xs, ys, index, gradient=None):
+        zs = np.where(index >= 0, vertices[index, 2], np.nan)
+        if gradient is not None:
+            colors = self._gradient_props(gradient, "surfacecolor", np.where(index >= 0, gradient.intensity[index], np.nan))
+        else:
+            color = self.style.color_str
+            colors = dict(colorscale = [[0, color], [1, color]], showscale = False)
+        surface = trace("surface",
+            x = xs, y = ys, z = zs,
+            lighting = self.lighting,
+            lightposition = dict(x=10000, y=10000, z=10000),
+            hovertemplate = self.hovertemplate[3],
+            **colors
+        )
+        self._append(surface)
+        self._extend(np.array([xs[0], ys[0], np.fmin.reduce(zs.ravel())]), np.array([xs[-1], ys[-1], np.fmax.reduce(zs.ravel())]))
+
+    # Filled shapes (rectangles, disks, small polygons) are batched into one
+    # nan-separated fill="toself" trace per style, rather than a trace per shape,
+    # which is very slow in Plotly.js for e.g. a 2000-bin histogram.
+    # Shapes in one trace are filled as a single path, so overlapping ones would
+    # not build up translucent color, and with opposite windings would cancel,
+    # leaving holes; so a shape only joins a batch whose shapes it doesn't overlap.
+    # Batching also moves a shape back in the drawing order, to just after the
+    # earlier shapes with its style, so it only joins the latest batch with its
+    # style if it doesn't overlap any batch drawn since.
+    # self.shapes is a list of batches [style, parts, boxes, lo, hi] in drawing
+    # order, where parts are nan-terminated (n, 2) arrays of points, boxes are the
+    # bounding boxes of the shapes (see last_overlapping), and lo, hi bound them all;
+    # self.shape_batches has the index of the latest batch by style.
+    # shapes is an (n, m, 2) array or list of (m, 2) arrays,
+    # all with the current style or color if given
+    def _add_shapes(self, shapes, color=None):
+
         if color is None:
-            fillcolor = self.style.color_str
-            line_color = self.style.edge_color_str
+            style = (self.style.color_str, self.style.edge_color_str, self.style.edge_thickness)
         else:
             fillcolor = to_color_str(color)
-            line_color = fillcolor
-        trace = go.Scatter(
-            x=xs, y=ys,
-            mode="lines", fill="toself", fillcolor=fillcolor,
-            line_width=self.style.edge_thickness, line_color=line_color
-        )
-        self.data.append(trace)
+            style = (fillcolor, fillcolor, self.style.edge_thickness)
+
+        # bounding box of each shape
+        if isinstance(shapes, np.ndarray):
+            boxes = np.stack([np.fmin.reduce(shapes, axis=1), np.fmax.reduce(shapes, axis=1)], axis=1)
+        else:
+            boxes = np.array([[np.fmin.reduce(shape, axis=0), np.fmax.reduce(shape, axis=0)] for shape in shapes])
+        if not len(boxes):
+            return
+        self._extend(np.fmin.reduce(boxes[:,0]), np.fmax.reduce(boxes[:,1]))
+
+        # the latest batch with this style if nothing since overlaps, else a new one
+        lo, hi = np.fmin.reduce(boxes[:,0]), np.fmax.reduce(boxes[:,1])
+        i = self.shape_batches.get(style)
+        if i is not None:
+            later = self.shapes[i+1:]
+            if not all((lo >= l_hi).any() or (l_lo >= hi).any() for _, _, _, l_lo, l_hi in later):
+                i = None
+
+        # of the shapes in that batch only those within our bounds can overlap ours
+        old = np.zeros((0, 2, 2))
+        batch = self.shapes[i] if i is not None else None
+        if batch is not None and ((batch[3] < hi) & (lo < batch[4])).all():
+            batch[2] = [np.concatenate(batch[2])]
+            old = batch[2][0]
+            old = old[((old[:,0] < hi) & (lo < old[:,1])).all(axis=1)]
+
+        # split the shapes into runs at each one that overlaps an earlier one in
+        # its run, or for the first run in the batch it's added to
+        m = len(old)
+        last = last_overlapping(np.concatenate([old, boxes]))[m:] - m
+        cuts, start = [], -m
+        for j, k in enumerate(last.tolist()):
+            if k >= start:
+                cuts.append(j)
+                start = j
+
+        # first run to that batch if any, the rest each to a new batch
+        for a, b in zip([0, *cuts], [*cuts, len(boxes)]):
+            if a < b:
+                if i is None:
+                    self.shapes.append([style, [], [], np.full(2, np.nan), np.full(2, np.nan)])
+                    i = self.shape_batches[style] = len(self.shapes) - 1
+                batch = self.shapes[i]
+                if isinstance(shapes, np.ndarray):
+                    n = b - a
+                    points = np.concatenate([shapes[a:b], np.full((n, 1, 2), np.nan)], axis=1).reshape(-1, 2)
+                else:
+                    nan = np.full((1, 2), np.nan)
+                    points = np.concatenate([part for shape in shapes[a:b] for part in (shape, nan)])
+                batch[1].append(points)
+                batch[2].append(boxes[a:b])
+                batch[3] = np.fmin(batch[3], np.fmin.reduce(boxes[a:b,0]))
+                batch[4] = np.fmax(batch[4], np.fmax.reduce(boxes[a:b,1]))
+            i = None
+
+    # make a fill trace for each batch of shapes
+    def _flush_shapes(self):
+        shapes, self.shapes, self.shape_batches = self.shapes, [], {}
+        for (fillcolor, line_color, line_width), parts, _, _, _ in shapes:
+            points = np.concatenate(parts)[:-1]
+            shape = trace("scatter",
+                x=points[:,0], y=points[:,1],
+                mode="lines", fill="toself", fillcolor=fillcolor,
+                line=dict(width=line_width, color=line_color)
+            )
+            self.data.append(shape)
 
     def add_rectangles(self, vertices, rectangles, colors):
-        for rectangle in rectangles:
-            lo, hi = rectangle
-            xs = [lo[0], lo[0], hi[0], hi[0]]
-            ys = [lo[1], hi[1], hi[1], lo[1]]
-            self._add_shape(xs, ys)
+        rectangles = np.array([rectangle for rectangle in rectangles], dtype=float).reshape(-1, 2, 2)
+        (x0, y0), (x1, y1) = rectangles[:,0].T, rectangles[:,1].T
+        xs = np.stack([x0, x0, x1, x1], axis=-1)
+        ys = np.stack([y0, y1, y1, y0], axis=-1)
+        self._add_shapes(np.stack([xs, ys], axis=-1))
 
     def add_disks(self, vertices, disks, colors):
-        for disk in disks:
 
-            # center
-            x, y = disk[0]
-            
-            # radii
+        # center, radii, and angles of each disk
+        centers, radii, angles = [], [], []
+        for disk in disks:
+            centers.append(disk[0])
             rx = ry = 1
             if len(disk) > 1:
                 if isinstance(disk[1], (list,tuple,np.ndarray)):
                     rx, ry = disk[1]
                 else:
                     rx = ry = disk[1]
+            radii.append((rx, ry))
+            angles.append(disk[2] if len(disk) > 2 else (0, 2 * np.pi))
+        if not centers:
+            return
+        centers, radii, angles = (np.array(a, dtype=float) for a in (centers, radii, angles))
 
-            # angles
-            a0, a1 = 0, 2 * np.pi
-            if len(disk) > 2:
-                a0, a1 = disk[2]
-            ts = np.linspace(a0, a1, 100)
-
-            # xs, ys
-            xs = x + rx * np.cos(ts)
-            ys = y + ry * np.sin(ts)
+        # outlines for all disks at once
+        ts = angles[:,:1] + (angles[:,1:] - angles[:,:1]) * np.linspace(0, 1, 100)
+        points = centers[:,None,:] + radii[:,None,:] * np.stack([np.cos(ts), np.sin(ts)], axis=-1)
 
-            # angle ends to center if not a full circle
-            diff = (a0 - a1 + np.pi) %  (2 * np.pi) - np.pi
-            if not np.isclose(diff, 0):
-                xs = np.append(xs, x)
-                ys = np.append(ys, y)
+        # angle ends to center if not a full circle;
+        # full circles just repeat their last point
+        diff = (angles[:,0] - angles[:,1] + np.pi) %  (2 * np.pi) - np.pi
+        ends = np.where(np.isclose(diff, 0)[:,None], points[:,-1], centers)
+        points = np.concatenate([points, ends[:,None,:]], axis=1)
 
-            self._add_shape(xs, ys)
+        self._add_shapes(points)
 
 
     # TODO: should maybe be passed in using vertices and colors?
     # instead of this way?
     def add_insets(self, vertices, insets, colors):
         for (x, y), text in insets:
-            trace = go.Scatter(x=[x], y=[y], mode="text", text=[text], textposition="middle center")
-            self.data.append(trace)
+            inset = trace("scatter", x=[x], y=[y], mode="text", text=[text], textposition="middle center")
+            self._append(inset)
+            self._extend(np.array([x, y], dtype=float), np.array([x, y], dtype=float))
 
 
     @util.Timer("figure")
     def figure(self):
 
+        self._flush_shapes()
         if not self.data:
             return None, 0
 
-        # compute data_range
-        with util.Timer("data_range"):
-            if self.dim == 3:
-                data = np.hstack([(trace.x, trace.y, trace.z) for trace in self.data])
-            else:
-                data = np.hstack([(trace.x, trace.y) for trace in self.data])
-            data_range = np.array([np.nanmin(data, axis=1), np.nanmax(data, axis=1)]).T
+        # data range from the bounding box maintained by add_*
+        data_range = np.stack([self.data_lo, self.data_hi], axis=-1)
 
         # get plot range either from opt or from data range
         plot_range = np.array([
@@ -345,8 +903,8 @@ class FigureBuilder:
         # compute axes options
         axes_opts = {}
         def title(t):
-            if self.dim==2: return t  # None means no label
-            if self.dim==3: return t or ""  # "" means no label
+            if self.dim==2: return dict(text=t) if t else {}  # no text means no label
+            if self.dim==3: return dict(text=t or "")  # "" means no label
         for i, p in enumerate("xyz" if self.dim==3 else "xy"):
             opts = dict(
                 linecolor = "black",
@@ -382,7 +940,7 @@ class FigureBuilder:
 
         if self.dim == 2:
 
-            go_layout = go.Layout(**layout_opts, **axes_opts)
+            layout = dict(**layout_opts, **axes_opts)
 
         elif self.dim == 3:
 
@@ -394,6 +952,7 @@ class FigureBuilder:
                 self.set_color_rgb((0,0,0), None)
                 self.set_thickness(1.5)
                 self.add_lines(vertices, lines, None)
+                self.data[-1]["name"] = "box"
 
             # ViewPoint
             xyz_to_dict = lambda xyz: {n: v for n, v in zip("xyz", xyz)}
@@ -420,12 +979,8 @@ class FigureBuilder:
                     p: self.opts.box_ratios[i] for i, p in enumerate("xyz")
                 }
 
-            # combine above into final go_layout
-            go_layout = go.Layout(**layout_opts, scene = scene)
-
-        # combine data and g_layout into final figure
-        with util.Timer("FigureWidget"):
-            figure = go.Figure(data=self.data, layout=go_layout)
+            # combine above into final layout
+            layout = dict(**layout_opts, scene = scene)
 
         # compute ticks for log plots
         if self.opts.log_plot:
@@ -434,17 +989,25 @@ class FigureBuilder:
             ticks = m3d.ticker.log10_ticks_for_logged_data_superscript(
                 log_vmin=lo, log_vmax=hi, minor=True, nticks=6
             )
-            figure.update_yaxes(**m3d.ticker.plotly_tick_array(ticks))
+            layout.setdefault("yaxis", {}).update(m3d.ticker.plotly_tick_array(ticks))
 
         # TODO: consider using for linear as well? plotly seems to do ok though
         #lo, hi = plot_range[0]
         #ticks = m3d.ticker.nice_linear_ticks(vmin=lo, vmax=hi, nticks=7)
-        #figure.update_xaxes(**m3d.ticker.plotly_tick_array(ticks))        
+        #layout.setdefault("xaxis", {}).update(m3d.ticker.plotly_tick_array(ticks))
 
         # background color
         if self.opts.background:
             background = to_color_str(self.opts.background)
-            figure.update_layout(paper_bgcolor=background)
+            layout["paper_bgcolor"] = background
+
+        # smaller dtypes and binary encoding for the trip to the browser
+        if m3d.transport.enabled:
+            m3d.transport.compact(self.data)
+
+        # combine data and layout into final figure
+        with util.Timer("FigureWidget"):
+            figure = go.Figure(data=self.data, layout=layout, _validate=validate)
 
         # if we're in test mode write the image
         if hasattr(self.fe, "test_image"):
@@ -0,0 +1,126 @@
+#
+# Simplification of large 3d triangle meshes, e.g. Plot3D with a high PlotPoints
+# and a ColorFunction, or a dense ParametricPlot3D, down to about as many
+# triangles as the figure can show.
+#
+# This is vertex clustering: we divide space into cubic cells, replace the
+# vertices in each cell by a single vertex at their average position with their
+# average color, and drop the triangles that collapse to a line or point, or
+# duplicate another. The cell size is chosen from the surface area so that
+# about budget triangles remain. Vertices on the boundary of the mesh, i.e. on
+# edges used by only one triangle, are kept as is, so that the outline of the
+# surface, and holes in it, don't move.
+#
+
+import numpy as np
+import numpy.linalg as la
+
+from m3d import util
+
+
+# simplify 3d meshes; overridden for individual graphics by Method -> {"Simplify" -> True|False}.
+# Never done when writing test images.
+enabled = True
+
+# triangle budget is one triangle per this many pixels of figure area
+pixels_per_triangle = 4
+
+# cell size is refined until we're within budget, at most this many times
+max_passes = 4
+
+
+# Triangle budget for a figure of the given ImageSize
+def budget(image_size):
+    width, height = image_size
+    return int(width * (height or width) / pixels_per_triangle)
+
+
+# Vertices used by exactly one edge of tris, i.e. on the boundary of the mesh
+def boundary_vertices(tris, nvertices):
+    edges = np.sort(np.concatenate([tris[:,[0,1]], tris[:,[1,2]], tris[:,[2,0]]]), axis=1)
+    keys = edges[:,0] * np.int64(nvertices) + edges[:,1]
+    keys.sort()
+    distinct = np.ones(len(keys), dtype=bool)
+    distinct[1:] = keys[1:] != keys[:-1]
+    starts = np.flatnonzero(distinct)
+    counts = np.diff(np.append(starts, len(keys)))
+    once = keys[starts[counts == 1]]
+    boundary = np.zeros(nvertices, dtype=bool)
+    boundary[once // nvertices] = boundary[once % nvertices] = True
+    return boundary
+
+
+# One clustering pass with cubic cells of the given size. fixed vertices
+# get clusters of their own. Returns the cluster of each vertex, and
+# the number of clusters.
+def cluster(vertices, fixed, lo, size):
+    with np.errstate(invalid="ignore"):
+        cells = np.where(fixed[:,None], 0, np.floor((vertices - lo) / size)).astype(np.int64)
+    n = cells.max(axis=0) + 1
+    keys = cells[:,0] + n[0] * (cells[:,1] + n[1] * cells[:,2])
+    keys = np.where(fixed, -1 - np.arange(len(vertices)), keys)
+    _, inverse = np.unique(keys, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    return inverse, inverse.max(initial=-1) + 1
+
+
+# Triangles of tris after replacing vertices by their clusters, without those
+# that are degenerate or duplicate an earlier one. Returns the indexes of the
+# triangles kept, in order.
+def surviving(tris, clusters, nclusters):
+    t = clusters[tris]
+    live = (t[:,0] != t[:,1]) & (t[:,1] != t[:,2]) & (t[:,2] != t[:,0])
+    t = np.sort(t, axis=1).astype(np.int64)
+    keys = (t[:,0] * nclusters + t[:,1]) * nclusters + t[:,2]
+    keys = np.where(live, keys, -1)
+    _, first = np.unique(keys, return_index=True)
+    return np.sort(first[live[first]])
+
+
+# Simplify the mesh given by vertices, an (n, 3) array of triangle indexes tris,
+# and optional per-vertex colors to about budget triangles. Returns the new vertices,
+# tris, and colors, plus the indexes into the original tris of the triangles kept,
+# for carrying per-triangle data along. Meshes within budget are returned as is.
+@util.Timer("simplify")
+def simplify(vertices, tris, colors, budget):
+
+    keep = np.arange(len(tris))
+    if len(tris) <= budget or budget <= 0:
+        return vertices, tris, colors, keep
+
+    # vertices that don't move: boundary, non-finite, or unused
+    used = np.bincount(tris.ravel(), minlength=len(vertices)) > 0
+    finite = np.isfinite(vertices).all(axis=1)
+    fixed = boundary_vertices(tris, len(vertices)) | ~finite | ~used
+
+    # cell size for which clustering a surface of this area leaves about budget
+    # triangles, assuming about two per occupied cell; refined by the actual result
+    corners = vertices[tris]
+    area = la.norm(np.cross(corners[:,1] - corners[:,0], corners[:,2] - corners[:,0]), axis=1) / 2
+    area = np.nansum(area)
+    if not area > 0:
+        return vertices, tris, colors, keep
+    lo = vertices[finite].min(axis=0)
+    size = np.sqrt(2 * area / budget)
+
+    for _ in range(max_passes):
+        clusters, nclusters = cluster(vertices, fixed, lo, size)
+        keep = surviving(tris, clusters, nclusters)
+        if len(keep) <= budget:
+            break
+        size *= np.sqrt(len(keep) / budget) * 1.1
+
+    # drop unused vertices, and average the rest by cluster
+    counts = np.bincount(clusters, weights=used, minlength=nclusters)
+    def average(values):
+        sums = [np.bincount(clusters, weights=np.where(used, v, 0), minlength=nclusters) for v in values.T]
+        with np.errstate(invalid="ignore"):
+            return np.stack(sums, axis=-1) / counts[:,None]
+    occupied = counts > 0
+    renumber = np.cumsum(occupied) - 1
+    new_vertices = average(vertices)[occupied]
+    new_colors = average(colors)[occupied] if colors is not None else None
+    new_tris = renumber[clusters[tris[keep]]]
+
+    return new_vertices, new_tris, new_colors, keep
+
@@ -13,6 +13,8 @@ SymbolPointBox = Symbol("PointBox")
 SymbolImageSize = Symbol("ImageSize")
 SymbolAxes = Symbol("Axes")
 SymbolHue = Symbol("Hue")
+SymbolGrayLevel = Symbol("GrayLevel")
+SymbolOpacity = Symbol("Opacity")
 SymbolAspectRatio = Symbol("AspectRatio")
 SymbolAxesStyle = Symbol("AxesStyle")
 SymbolBackground = Symbol("Background")
@@ -22,6 +24,13 @@ SymbolLabelStyle = Symbol("LabelStyle")
 SymbolLighting = Symbol("Lighting")
 SymbolPlotRange = Symbol("PlotRange")
 SymbolPlotRangePadding = Symbol("PlotRangePadding")
+SymbolPlotPoints = Symbol("PlotPoints")
+SymbolMaxRecursion = Symbol("MaxRecursion")
+SymbolPlot = Symbol("Plot")
+SymbolDensityPlot = Symbol("DensityPlot")
+SymbolContourPlot = Symbol("ContourPlot")
+SymbolPlot3D = Symbol("Plot3D")
+SymbolParametricPlot = Symbol("ParametricPlot")
 SymbolTicksStyle = Symbol("TicksStyle")
 SymbolViewPoint = Symbol("ViewPoint")
 SymbolManipulateBox = Symbol("ManipulateBox")
@@ -0,0 +1,97 @@
+#
+# Compact transport of figure data to the browser.
+#
+# By default trace arrays go out as float64, and index arrays as int64.
+# When enabled, compact() downcasts them before the figure is built:
+# coordinates to float32 where that loses nothing visible, and indexes to
+# the smallest unsigned int type that holds them. With encode, arrays are
+# also replaced by Plotly.js typed array specs {"dtype", "bdata"}, base64
+# of the raw little-endian bytes, so they don't depend on how whatever
+# serializes the figure handles numpy arrays.
+#
+
+import base64
+
+import numpy as np
+
+from m3d import util
+
+
+# opt-in; see also --binary-transport
+enabled = False
+
+# encode arrays as {"dtype", "bdata"} instead of leaving them as numpy arrays
+encode = True
+
+# float32 is used only if its rounding error is below this fraction of the data extent
+float32_tolerance = 1e-6
+
+# numeric trace properties that hold coordinates or values, and those that hold indexes
+value_props = ("x", "y", "z", "intensity", "surfacecolor")
+index_props = ("i", "j", "k")
+
+
+# Smallest unsigned int type that holds non-negative integer array a
+def index_dtype(a):
+    hi = a.max(initial=0)
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if hi <= np.iinfo(dtype).max:
+            return dtype
+    return a.dtype
+
+
+# Downcast float array a to float32 if the rounding error is negligible
+# compared to the extent of the data. Non-finite values survive the cast.
+def value_dtype(a):
+    finite = a[np.isfinite(a)]
+    if not len(finite):
+        return np.float32
+    lo, hi = finite.min(), finite.max()
+    magnitude = max(abs(lo), abs(hi))
+    if magnitude * np.finfo(np.float32).eps <= (hi - lo) * float32_tolerance:
+        return np.float32
+    return a.dtype
+
+
+# Plotly.js typed array spec for array a
+def typed_array(a):
+    a = np.ascontiguousarray(a, dtype=a.dtype.newbyteorder("<"))
+    return {
+        "dtype": a.dtype.str[1:],
+        "bdata": base64.b64encode(a.tobytes()).decode("ascii"),
+        **({"shape": ",".join(str(n) for n in a.shape)} if a.ndim > 1 else {})
+    }
+
+
+# The numpy array for a trace property value, which may be
+# a typed array spec from typed_array
+def array(value):
+    if isinstance(value, dict) and "bdata" in value:
+        a = np.frombuffer(base64.b64decode(value["bdata"]), dtype=np.dtype(value["dtype"]).newbyteorder("<"))
+        if "shape" in value:
+            a = a.reshape([int(n) for n in value["shape"].split(",")])
+        return a
+    return np.asarray(value)
+
+
+def compact_array(a, index):
+    if index and np.issubdtype(a.dtype, np.integer) and a.min(initial=0) >= 0:
+        a = a.astype(index_dtype(a), copy=False)
+    elif not index and a.dtype == np.float64:
+        a = a.astype(value_dtype(a), copy=False)
+    else:
+        return a
+    return typed_array(a) if encode else a
+
+
+# Compact the numeric arrays of traces in place. Traces may be plotly
+# graph objects or plain dicts.
+@util.Timer("compact")
+def compact(traces):
+    for trace in traces:
+        for props, index in ((value_props, False), (index_props, True)):
+            for prop in props:
+                if prop in trace:
+                    value = trace[prop]
+                    if isinstance(value, np.ndarray) and value.size and value.dtype.kind in "fiu":
+                        trace[prop] = compact_array(value, index)
@@ -0,0 +1,167 @@
+#
+# Triangulation of polygons for Mesh3d.
+#
+# Polygons are fan-triangulated from their first vertex in bulk, which is right
+# for convex polygons, i.e. nearly everything plotting functions produce. We then
+# find the non-convex ones that the fan gets wrong, with triangles outside the
+# polygon, by a vectorized test for fan triangles that fold over, and re-triangulate
+# just those by ear clipping, writing the result into the same triangle slots so
+# that triangle_owners still holds. The fold test is most of the cost.
+#
+
+import numpy as np
+
+from m3d import util
+from m3d.consumer import Ragged
+
+
+# relative tolerance for a triangle to count as facing the wrong way
+fold_tolerance = 1e-9
+
+
+# Fan-triangulate polys, given as indexes into vertices, from the first vertex of
+# each poly. Returns an (n, 3) array of indexes. polys is either a uniform (m, ngon)
+# array or a Ragged batch, which is triangulated in one go without looping over polys.
+def fan(polys):
+    if isinstance(polys, Ragged):
+        offsets, values = polys
+        ntris = np.maximum(np.diff(offsets) - 2, 0)
+        firsts = np.repeat(offsets[:-1], ntris)
+        # k is the index of each triangle within its poly
+        k = np.arange(ntris.sum()) - np.repeat(np.cumsum(ntris) - ntris, ntris)
+        return values[np.stack([firsts, firsts + k + 1, firsts + k + 2], axis=-1)]
+    else:
+        ngon = polys.shape[1]
+        inx = [[0, i, i+1] for i in range(1, ngon-1)]
+        return polys[:, inx].transpose(1, 0, 2).reshape((-1, 3))
+
+
+# For each triangle produced by fan(polys) or triangulate(vertices, polys),
+# the index of the poly it came from
+def triangle_owners(polys):
+    if isinstance(polys, Ragged):
+        ntris = np.maximum(np.diff(polys.offsets) - 2, 0)
+        return np.repeat(np.arange(len(ntris)), ntris)
+    else:
+        return np.tile(np.arange(len(polys)), polys.shape[1] - 2)
+
+
+# Returns slots(p), the positions in fan(polys) of the triangles of poly p
+def triangle_slots(polys):
+    if isinstance(polys, Ragged):
+        ntris = np.maximum(np.diff(polys.offsets) - 2, 0)
+        starts = np.cumsum(ntris) - ntris
+        return lambda p: np.arange(starts[p], starts[p] + ntris[p])
+    else:
+        return lambda p: p + len(polys) * np.arange(polys.shape[1] - 2)
+
+
+# The vertex indexes of poly p
+def poly_indexes(polys, p):
+    if isinstance(polys, Ragged):
+        return polys.values[polys.offsets[p]:polys.offsets[p+1]]
+    return polys[p]
+
+
+# Indexes of the polys whose fan triangles tris, from fan(polys), fold over: some
+# triangle faces the opposite way from the poly as a whole, whose normal is the sum
+# of its triangles' normals (as in Newell's method). That happens for non-convex
+# polys when the fan crosses outside them. Triangles, and polys with non-finite
+# coordinates, always pass since ear clipping can't do better for them.
+# Coordinates are handled one axis at a time, which is much faster than
+# (n, 3) arrays and np.cross.
+def folded(vertices, polys, tris):
+
+    if isinstance(polys, Ragged):
+        npolys = len(polys.offsets) - 1
+    else:
+        npolys = len(polys)
+        if polys.shape[1] < 4:
+            return np.zeros(0, dtype=np.int64)
+
+    # normal of each triangle
+    x, y, z = (np.ascontiguousarray(vertices[:,i])[tris] for i in range(3))
+    ux, uy, uz = x[:,1] - x[:,0], y[:,1] - y[:,0], z[:,1] - z[:,0]
+    wx, wy, wz = x[:,2] - x[:,0], y[:,2] - y[:,0], z[:,2] - z[:,0]
+    n = [uy * wz - uz * wy, uz * wx - ux * wz, ux * wy - uy * wx]
+
+    # normal of each poly, for each of its triangles
+    if isinstance(polys, Ragged):
+        owners = triangle_owners(polys)
+        total = [np.bincount(owners, weights=c, minlength=npolys)[owners] for c in n]
+    else:
+        total = [np.tile(c.reshape(-1, npolys).sum(axis=0), polys.shape[1] - 2) for c in n]
+
+    dot = n[0] * total[0] + n[1] * total[1] + n[2] * total[2]
+    scale = np.sqrt((n[0]**2 + n[1]**2 + n[2]**2) * (total[0]**2 + total[1]**2 + total[2]**2))
+    wrong = dot < -fold_tolerance * scale
+
+    if isinstance(polys, Ragged):
+        bad = np.bincount(owners[wrong], minlength=npolys) > 0
+    else:
+        bad = wrong.reshape(-1, npolys).any(axis=0)
+    return np.flatnonzero(bad)
+
+
+# Ear-clip a simple polygon given by its (n, 3) corner coordinates.
+# Returns an (n-2, 3) array of corner indexes, with the orientation of the
+# polygon, or None if the polygon is degenerate or not simple.
+def ear_clip(points):
+
+    n = len(points)
+    if n < 3 or not np.isfinite(points).all():
+        return None
+
+    # project onto the coordinate plane most nearly parallel to the polygon,
+    # and orient so that the polygon winds counterclockwise
+    after = np.roll(points, -1, axis=0)
+    normal = (points[:,[1,2,0]] * after[:,[2,0,1]] - points[:,[2,0,1]] * after[:,[1,2,0]]).sum(axis=0)
+    axis = np.argmax(np.abs(normal))
+    xy = np.delete(points, axis, axis=1)
+    x, y = xy[:,0], xy[:,1]
+    area = (x * np.roll(y, -1) - np.roll(x, -1) * y).sum()
+    if area == 0:
+        return None
+    sign = np.sign(area)
+
+    def turn(a, b, c):
+        return sign * ((b[...,0] - a[...,0]) * (c[...,1] - a[...,1]) - (b[...,1] - a[...,1]) * (c[...,0] - a[...,0]))
+
+    remaining = list(range(n))
+    tris = []
+    while len(remaining) > 3:
+        r = np.array(remaining)
+        a, b, c = xy[np.roll(r, 1)], xy[r], xy[np.roll(r, -1)]
+        convex = turn(a, b, c) > 0
+        for k in np.flatnonzero(convex):
+            # an ear if no other remaining corner is strictly inside it
+            others = xy[r]
+            inside = (turn(a[k], b[k], others) > 0) & (turn(b[k], c[k], others) > 0) & (turn(c[k], a[k], others) > 0)
+            if not inside.any():
+                m = len(r)
+                tris.append([r[(k - 1) % m], r[k], r[(k + 1) % m]])
+                del remaining[k]
+                break
+        else:
+            return None
+    tris.append(remaining)
+    return np.array(tris)
+
+
+# Triangulate polys, given as indexes into vertices, as described above.
+# Returns an (n, 3) array of indexes into vertices, parallel to triangle_owners(polys).
+@util.Timer("triangulate")
+def triangulate(vertices, polys):
+
+    tris = fan(polys)
+    with util.Timer("folded"):
+        bad = folded(vertices, polys, tris)
+
+    slots = triangle_slots(polys)
+    for p in bad:
+        indexes = poly_indexes(polys, p)
+        local = ear_clip(vertices[indexes])
+        if local is not None:
+            tris[slots(p)] = indexes[local]
+
+    return tris
@@ -1,18 +1,22 @@
 import time
+import collections
+import ctypes
 import itertools
 import threading
 import os
 import pathlib
 
+import numpy as np
 import panel as pn
 import panel.io
+from panel.io.state import set_curdoc
 import plotly.graph_objects as go
 import bokeh.models
 
 import m3d.layout
 import m3d.ui
 import m3d.test_ui
-from m3d import util
+from m3d import core, util
 
 pn.extension(raw_css=[open(util.resource("m3d.css")).read()])
 
@@ -89,17 +93,319 @@ def grid(grid_content):
     return layout
 
 
-def graph(figure, height):
+# if on_zoom is given, zooming calls it with the new x and y ranges
+# ([lo, hi], or None if unchanged) and the figure size, and it returns a
+# layout with a re-sampled figure to replace ours, or None to keep ours;
+# resetting the axes goes back to the original figure
+def graph(figure, height, on_zoom=None):
     plot = pn.pane.Plotly(
         figure,
         #config={"displayModeBar": False}, # TODO: do we still want this?
         css_classes = ["m-plot"]
     )
     plot._m3d_height = height
+
+    if on_zoom is not None:
+
+        original = figure
+        last = None
+
+        # re-sampling is evaluation, which we do in an UpdateScheduler, as for
+        # Manipulate, so it doesn't hold up the server and only the latest zoom
+        # is evaluated; ranges None means go back to the original figure
+        def compute(ranges, final, aborted):
+            if ranges is None:
+                return original
+            with util.Timer("zoom"):
+                layout = on_zoom(ranges, (original.layout.width, original.layout.height))
+            if not isinstance(layout, pn.pane.Plotly) or aborted():
+                return None
+            # keep exactly the view the user chose, not the padded plot range
+            zoomed = layout.object
+            for p, r in zip("xy", ranges):
+                if r is not None:
+                    zoomed.layout[p+"axis"].range = r
+            return zoomed
+        def show(zoomed):
+            plot.object = zoomed
+        scheduler = UpdateScheduler(compute, show)
+
+        def relayout(event):
+            nonlocal last
+            data = event.new or {}
+            if data.get("xaxis.autorange") or data.get("yaxis.autorange"):
+                last = None
+                scheduler.request(None, final=True)
+                return
+            ranges = [
+                [data[f"{p}axis.range[0]"], data[f"{p}axis.range[1]"]]
+                if f"{p}axis.range[0]" in data else None
+                for p in "xy"
+            ]
+            if ranges == [None, None] or ranges == last:
+                return
+            last = ranges
+            scheduler.request(ranges, final=True)
+
+        plot.param.watch(relayout, "relayout_data")
+
     return plot
 
 
-def manipulate(init_target_layout, sliders, eval_and_layout):
+# Flatten nested dicts of plotly properties to {"a.b.c": value} as used by
+# restyle and relayout, stopping at typed array specs, which are values
+def flatten_props(props, prefix=""):
+    flat = {}
+    for name, value in props.items():
+        if isinstance(value, dict) and value and "bdata" not in value:
+            flat.update(flatten_props(value, f"{prefix}{name}."))
+        else:
+            flat[prefix + name] = value
+    return flat
+
+
+# Flattened trace and layout properties of figure, for patch_figure.
+# The layout template is left out since it's always the default.
+def figure_props(figure):
+    layout = figure.layout.to_plotly_json()
+    layout.pop("template", None)
+    return [flatten_props(t.to_plotly_json()) for t in figure.data], flatten_props(layout)
+
+
+def same_value(a, b):
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        a, b = np.asarray(a), np.asarray(b)
+        if a.shape != b.shape or a.dtype != b.dtype:
+            return False
+        return np.array_equal(a, b, equal_nan=a.dtype.kind in "fc")
+    try:
+        return bool(a == b)
+    except ValueError:
+        return False
+
+
+# Patch figure, currently shown with properties props from figure_props,
+# in place to match new_props, sending the browser only the trace properties
+# and layout values that changed, as plotly updates (restyle plus relayout)
+# that pn.pane.Plotly forwards. The camera and anything else that's the same
+# stays as it is, so e.g. a rotated 3d view doesn't jump.
+# Returns False, leaving figure alone, if the traces don't correspond.
+def patch_figure(figure, props, new_props):
+
+    (traces, layout), (new_traces, new_layout) = props, new_props
+    if len(traces) != len(new_traces):
+        return False
+    if any(t.get("type") != n.get("type") for t, n in zip(traces, new_traces)):
+        return False
+
+    def changes(old, new):
+        changed = {name: value for name, value in new.items() if name not in old or not same_value(old[name], value)}
+        changed.update({name: None for name in old if name not in new})
+        return changed
+
+    # group traces with the same changed properties into one restyle
+    restyles = {}
+    for i, (t, n) in enumerate(zip(traces, new_traces)):
+        changed = changes(t, n)
+        if changed:
+            indexes, values = restyles.setdefault(tuple(sorted(changed)), ([], []))
+            indexes.append(i)
+            values.append(changed)
+    relayout = changes(layout, new_layout)
+
+    if not restyles and not relayout:
+        return True
+    if not restyles:
+        figure.plotly_relayout(relayout)
+    for names, (indexes, values) in restyles.items():
+        restyle = {name: [v[name] for v in values] for name in names}
+        figure.plotly_update(restyle_data=restyle, relayout_data=relayout, trace_indexes=indexes)
+        relayout = {}
+    return True
+
+
+class UpdateScheduler:
+
+    """
+    Runs updates for a stream of requests, e.g. slider positions, in a worker
+    thread: result = compute(request, final, aborted), which may be slow and
+    can be aborted, then show(result) in the thread of the Bokeh document we
+    were created in, where models may be changed. Only the latest request
+    matters, so requests that arrive while an update is running replace each
+    other, and the latest runs when the current one is done. Updates start at
+    most once per frame_budget seconds, except final ones (e.g. a slider
+    released), which also abort a stale computation in flight, as do requests
+    arriving after it has run for abort_after seconds. Aborting raises Mathics'
+    AbortInterrupt in the worker. Mathics may catch that and return a partial
+    result, so compute can call aborted() to tell, e.g. to avoid caching it,
+    and results of aborted computations are never shown.
+    Non-final requests may be computed more cheaply, e.g. at lower resolution,
+    so if no new request arrives within refine_after seconds of showing one
+    it is requested again as final.
+    Once the result of a final request is shown, the worker runs the jobs
+    idle(request) returns, if given, one at a time as job(aborted), e.g. to
+    prefetch likely next results. A new request aborts the job in progress.
+    Where we can't start threads, i.e. under Pyodide, updates run in turn
+    through pn.state.execute, without aborting, refinement, or idle jobs.
+    """
+
+    frame_budget = 1 / 30
+    abort_after = 0.5
+    refine_after = 0.3
+
+    def __init__(self, compute, show, idle=None):
+        self.compute = compute
+        self.show = show
+        self.idle = idle
+        self.threaded = util.threads
+        self.document = pn.state.curdoc
+        self.lock = threading.Lock()
+        self.pending = None      # (request, final, time requested) waiting to run
+        self.current = None      # (request, final, time requested) running, None for a job
+        self.jobs = None         # iterator of idle jobs while idle
+        self.worker = None       # ident of the worker thread while it runs
+        self.computing = None    # time compute or a job started, while running
+        self.aborted = False     # whether the computation running or last run was aborted
+        self.last_start = 0
+        self.refine = None       # timer for the final request after a non-final one
+        self.counts = collections.Counter()
+        self.latencies = collections.deque(maxlen=100)
+
+    def request(self, request, final=False):
+        with self.lock:
+            self.counts["requests"] += 1
+            self.jobs = None
+            if self.refine is not None:
+                self.refine.cancel()
+                self.refine = None
+            if self.pending is not None:
+                self.counts["superseded"] += 1
+            self.pending = (request, final, time.time())
+            start = self.worker is None
+            if start:
+                self.worker = True
+            elif self.computing is not None and self.threaded:
+                if self.current is None:
+                    self.abort()
+                elif self.current[0] != request:
+                    if final or time.time() - self.computing > self.abort_after:
+                        self.abort()
+        if start and self.threaded:
+            threading.Thread(target=self.run, daemon=True).start()
+        elif start:
+            pn.state.execute(self.run)
+
+    # raise AbortInterrupt in the worker; called with the lock held while computing
+    def abort(self):
+        self.counts["aborted"] += 1
+        self.aborted = True
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(
+            ctypes.c_ulong(self.worker), ctypes.py_object(core.AbortInterrupt)
+        )
+        self.computing = None
+
+    # passed to compute and jobs
+    def is_aborted(self):
+        return self.aborted
+
+    def run(self):
+        with self.lock:
+            self.worker = threading.get_ident()
+        while True:
+            try:
+
+                # wait for our frame budget if the next thing is a non-final request
+                with self.lock:
+                    if self.pending is None and self.jobs is None:
+                        self.worker = None
+                        return
+                    delay = 0
+                    if self.threaded and self.pending is not None and not self.pending[1]:
+                        delay = self.last_start + self.frame_budget - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+                # next request, or else idle job
+                with self.lock:
+                    job = None
+                    if self.pending is not None:
+                        self.current, self.pending = self.pending, None
+                        self.last_start = time.time()
+                    elif self.jobs is not None:
+                        job = next(self.jobs, None)
+                        if job is None:
+                            self.jobs = None
+                            continue
+                        self.current = None
+                    else:
+                        continue
+                    self.aborted = False
+                    self.computing = time.time()
+
+                try:
+                    if job is not None:
+                        job(self.is_aborted)
+                        continue
+                    request, final, requested = self.current
+                    result = self.compute(request, final, self.is_aborted)
+                finally:
+                    with self.lock:
+                        self.computing = None
+
+                with self.lock:
+                    if self.aborted or result is None:
+                        continue
+                self.deliver(result, requested)
+
+                # refine a non-final result, or do idle work after a final one
+                with self.lock:
+                    if self.pending is None and self.threaded:
+                        if not final:
+                            self.refine = threading.Timer(self.refine_after, self.request, (request, True))
+                            self.refine.daemon = True
+                            self.refine.start()
+                        elif self.idle is not None:
+                            self.jobs = iter(self.idle(request))
+
+            except core.AbortInterrupt:
+                # aborted, possibly just after compute returned; the
+                # pending request that aborted us runs next
+                pass
+            except Exception:
+                util.print_exc_reversed()
+
+    # show result in the document's thread
+    def deliver(self, result, requested):
+        def show():
+            try:
+                with set_curdoc(self.document):
+                    self.show(result)
+            except Exception:
+                util.print_exc_reversed()
+            with self.lock:
+                self.counts["shown"] += 1
+                self.latencies.append(time.time() - requested)
+        if self.threaded and self.document is not None:
+            self.document.add_next_tick_callback(show)
+        else:
+            show()
+
+    # counts of requests, superseded (never run), aborted, and shown updates,
+    # and latency from request to shown in ms over recent updates
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+        return dict(
+            self.counts,
+            latency_last = latencies[-1] if len(latencies) else None,
+            latency_mean = latencies.mean() if len(latencies) else None,
+            latency_max = latencies.max() if len(latencies) else None,
+        )
+
+
+# idle(values), if given, returns jobs for UpdateScheduler to run while
+# the sliders are idle at values
+def manipulate(init_target_layout, sliders, eval_and_layout, idle=None):
 
     # wrap plotly figures in pn.pane.Plotly for more efficient updates
     # else just use a Column (TODO: any better way in this case?)
@@ -113,64 +419,44 @@ def manipulate(init_target_layout, sliders, eval_and_layout):
             return pn.Column(x)
 
     # update the layout depending on how we wrapped it
-    # and how we're updating it
+    # and how we're updating it: a figure replacing the one we're showing is
+    # patched into it if it has the same traces, otherwise replaces it;
+    # a constant uirevision keeps the user's camera and zoom if it's replaced
+    shown_props = None
     def update(x, v):
+        nonlocal shown_props
         if isinstance(x, pn.pane.Plotly):
-            if isinstance(x, pn.pane.Plotly):
-                x.object = v.object
-            elif isinstance(v, go.Figure):
-                x.object = v
+            figure = v.object if isinstance(v, pn.pane.Plotly) else v
+            if isinstance(figure, go.Figure):
+                figure.layout.uirevision = "manipulate"
+                props = figure_props(figure)
+                patched = False
+                if isinstance(x.object, go.Figure):
+                    if shown_props is None:
+                        shown_props = figure_props(x.object)
+                    with util.Timer("patch figure"):
+                        patched = patch_figure(x.object, shown_props, props)
+                if not patched:
+                    # a copy, since we patch what we show, and figure may be cached
+                    x.object = go.Figure(
+                        data = [t.to_plotly_json() for t in figure.data],
+                        layout = figure.layout.to_plotly_json(),
+                        _validate = False
+                    )
+                shown_props = props
         elif isinstance(x, pn.Column):
             x[0] = v
 
-    # state for "debouncing" slider updates so that if they come in
-    # faster than we can process them we coalesce consecutive slider events
-    update_lock = threading.Lock()
-    update_running = False
-    update_requested = False
-    update_last = None
-    update_interval_min = float("inf")
-
-    # called on each slider event (on the main thread)
-    # if an update is already running, we just set the update_requested flag,
-    # and the running update will see it and schedule another update
-    # otherwise we schdule the update ourselves
-    def request_update(self):
-        nonlocal update_running
-        nonlocal update_requested
-        with update_lock:
-            if update_running:
-                request_update = True
-                return
-            update_running = True
-        pn.state.execute(run_update)
-
-    def stats():
-        nonlocal update_last
-        nonlocal update_interval_min
-        if update_last:
-            update_interval = (time.time() - update_last) * 1000
-            update_interval_min = min(update_interval_min, update_interval)
-            print(f"update interval: {update_interval:.1f} ms, min {update_interval_min:.1f} ms")
-        update_last = time.time()
-
-    # runs in a worker thread managed by panel to perform an update
-    # sets the running flag so that new update reequests don't run until we're done
-    # when we're done if we see that a new update has been requested we schedule it
-    def run_update():
-        nonlocal update_running
-        stats()
-        try:
-            with util.Timer("slider update"):
-                values = [s.value for s in pn_sliders]                
-                target_layout = eval_and_layout(values)
-                update(target, target_layout)
-        finally:
-            with update_lock:
-                if not update_requested:
-                    update_running = False
-                    return
-        pn.state.execute(run_update) # if requested
+    # slider updates go through a scheduler so that if they come in faster
+    # than we can process them only the latest is run
+    def values():
+        return [s.value for s in pn_sliders]
+    # while dragging we show a quick coarse result if there is one, and the
+    # full one once the slider has been idle for a moment or is released
+    def compute(values, final, aborted):
+        with util.Timer("slider update"):
+            return eval_and_layout(values, coarse=not final, aborted=aborted)
+    scheduler = UpdateScheduler(compute, lambda layout: update(target, layout), idle)
 
     # build sliders
     pn_sliders = []
@@ -188,8 +474,10 @@ def manipulate(init_target_layout, sliders, eval_and_layout):
         )
         readout = pn.widgets.StaticText(value=f"{slider.value:.2f}")
 
-        # keep target in sync with slider
-        slider.param.watch(request_update, "value")
+        # keep target in sync with slider while dragging,
+        # and make sure we show where it was released
+        slider.param.watch(lambda event: scheduler.request(values()), "value")
+        slider.param.watch(lambda event: scheduler.request(values(), final=True), "value_throttled")
 
         # keep readout in sync with slider
         def update_readout(event):
@@ -212,6 +500,8 @@ def manipulate(init_target_layout, sliders, eval_and_layout):
 
     # wrap the layout for efficient update
     target = wrap(init_target_layout)
+    if isinstance(target, pn.pane.Plotly) and isinstance(target.object, go.Figure):
+        target.object.layout.uirevision = "manipulate"
 
     # main layout: target on top, sliders below
     layout = pn.Column(
@@ -220,6 +510,7 @@ def manipulate(init_target_layout, sliders, eval_and_layout):
         width_policy="min",
         css_classes = ["m-manipulate"]
     )
+    layout._m3d_scheduler = scheduler
 
     return layout
 
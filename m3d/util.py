@@ -15,6 +15,20 @@ from mathics.timing import *
 
 import m3d
 
+# whether we can run work in threads of our own; not under Pyodide
+threads = sys.platform != "emscripten"
+
+# A Mathics session can only do one evaluation at a time, so evaluations in it,
+# by notebook cells, Manipulate, and zoom, take this lock for the session.
+# It's reentrant since laying out the result of a cell can evaluate too,
+# e.g. the initial values of a Manipulate.
+evaluation_locks_lock = threading.Lock()
+def evaluation_lock(session):
+    with evaluation_locks_lock:
+        if not hasattr(session, "_m3d_evaluation_lock"):
+            session._m3d_evaluation_lock = threading.RLock()
+        return session._m3d_evaluation_lock
+
 def resource(fn):
     return str(pathlib.Path(__file__).resolve().parent / fn)
 
@@ -0,0 +1,153 @@
+"""
+Re-sampling of plots on zoom. When the user zooms into a Plot, DensityPlot,
+or ContourPlot we re-evaluate the originating expression over just the zoomed
+region, at a resolution matched to the figure size, instead of letting Plotly
+magnify the samples we already have. ui.graph handles the relayout events;
+this module knows how to rewrite and evaluate the expression.
+
+The expression is re-evaluated in the current state of the session, so if
+the definitions of the global symbols it depends on have changed since the
+graphic was made, e.g. the function being plotted, we don't re-sample, as
+that would draw something different.
+"""
+
+from m3d import core, sym, util
+import m3d.layout
+
+
+# re-sample plots on zoom
+enabled = True
+
+# plotting functions we can re-sample, with the number of leading
+# {v, lo, hi} iterators, in x, y order, that give their domain
+domains = {
+    sym.SymbolPlot: 1,
+    sym.SymbolDensityPlot: 2,
+    sym.SymbolContourPlot: 2,
+}
+
+# figure pixels per sample when choosing PlotPoints, by number of iterators
+pixels_per_sample = {1: 4, 2: 8}
+
+
+# The user rules defining name, or none if it has no user definition
+def rules(definitions, name):
+    try:
+        definition = definitions.get_user_definition(name, create=False)
+    except Exception:
+        return []
+    if definition is None:
+        return []
+    return [
+        rule
+        for values in ("ownvalues", "downvalues", "subvalues", "upvalues")
+        for rule in getattr(definition, values, None) or ()
+    ]
+
+
+# The rules for the global symbols that expr depends on: those in it, and in
+# turn those in their rules. Returns a dict by name, whose rules we compare by
+# identity, since assigning makes new rules.
+def dependencies(definitions, expr):
+    found = {}
+    todo = [expr]
+    while todo:
+        e = todo.pop()
+        if isinstance(e, core.Symbol):
+            name = e.get_name()
+            if name.startswith("Global`") and name not in found:
+                found[name] = rules(definitions, name)
+                for rule in found[name]:
+                    pattern = getattr(rule, "pattern", None)
+                    todo.extend([getattr(pattern, "expr", pattern), getattr(rule, "replace", None)])
+        elif e is not None:
+            todo.append(getattr(e, "head", None))
+            todo.extend(getattr(e, "elements", ()))
+    return found
+
+
+def unchanged(old, new):
+    return old.keys() == new.keys() and all(
+        len(old[name]) == len(new[name]) and all(a is b for a, b in zip(old[name], new[name]))
+        for name in old
+    )
+
+
+# Given the unevaluated expression that a graphic came from, returns a function
+# resample(ranges, size) that re-evaluates it over the zoomed ranges ([lo, hi], or
+# None if not zoomed, for x and y) at a resolution for a figure of size
+# (width, height), and returns a layout for the result, or None if the
+# definitions source depends on have changed since we were called.
+# Returns None if source isn't something we know how to re-sample.
+def resampler(fe, source):
+
+    if not enabled or getattr(source, "head", None) not in domains:
+        return None
+    n = domains[source.head]
+    f, iterators, options = source.elements[0], source.elements[1:1+n], source.elements[1+n:]
+    if len(iterators) < n or any(
+        getattr(it, "head", None) is not sym.SymbolList or len(it.elements) != 3
+        for it in iterators
+    ):
+        return None
+
+    # the state of the definitions it depends on, as we were evaluated
+    definitions = fe.session.evaluation.definitions
+    depends = dependencies(definitions, source)
+
+    # PlotPoints given by the user, which we don't go below, per iterator
+    given = [0] * n
+    for o in options:
+        if getattr(o, "head", None) is sym.SymbolRule and o.elements[0] is sym.SymbolPlotPoints:
+            points = o.elements[1].to_python()
+            points = points if isinstance(points, (list, tuple)) else [points] * n
+            given = [p if isinstance(p, int) and not isinstance(p, bool) else 0 for p in points][:n]
+            given += [0] * (n - len(given))
+
+    # options we'll supply ourselves
+    replaced = (sym.SymbolPlotRange, sym.SymbolPlotPoints)
+    options = [
+        o for o in options
+        if not (getattr(o, "head", None) is sym.SymbolRule and o.elements[0] in replaced)
+    ]
+
+    def List(*elements):
+        return core.Expression(sym.SymbolList, *elements)
+
+    # the source rewritten for the zoomed ranges and figure size
+    def zoomed_expr(ranges, size):
+
+        # narrow the iterators to the zoomed ranges
+        zoomed = []
+        for it, r in zip(iterators, ranges):
+            v, lo, hi = it.elements
+            if r is not None:
+                lo, hi = core.Real(float(r[0])), core.Real(float(r[1]))
+            zoomed.append(List(v, lo, hi))
+
+        # PlotPoints to match the figure size, or more if the user asked for more
+        plot_points = [
+            core.Integer(max(2, int(s / pixels_per_sample[n]), g))
+            for s, g in zip(size[:n], given)
+        ]
+        extra = [core.Expression(sym.SymbolRule, sym.SymbolPlotPoints, plot_points[0] if n == 1 else List(*plot_points))]
+
+        # for Plot the y range isn't part of the domain
+        if n == 1:
+            y = ranges[1] if len(ranges) > 1 else None
+            y = sym.SymbolAutomatic if y is None else List(core.Real(float(y[0])), core.Real(float(y[1])))
+            x = List(*zoomed[0].elements[1:])
+            extra.append(core.Expression(sym.SymbolRule, sym.SymbolPlotRange, List(x, y)))
+
+        return core.Expression(source.head, f, *zoomed, *options, *extra)
+
+    def resample(ranges, size):
+        with util.evaluation_lock(fe.session):
+            if not unchanged(depends, dependencies(definitions, source)):
+                return None
+            expr = zoomed_expr(ranges, size)
+            with util.Timer("zoom re-evaluate"):
+                expr = expr.evaluate(fe.session.evaluation)
+            return m3d.layout.expression_to_layout(fe, expr)
+
+    return resample
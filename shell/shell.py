@@ -42,9 +42,10 @@ class Shell:
 
             try:
                 # evaluate
-                self.session.evaluation.out.clear()
-                expr = self.session.parse(expr_str)
-                expr = expr.evaluate(self.session.evaluation)
+                with m3d.util.evaluation_lock(self.session):
+                    self.session.evaluation.out.clear()
+                    expr = self.session.parse(expr_str)
+                    expr = expr.evaluate(self.session.evaluation)
 
                 # here's where we show output on terminal
                 print("\no>", expr.head if hasattr(expr, "head") else str(expr))
@@ -0,0 +1,31 @@
+"""
+Fixtures for the Python-level tests. The .m3d tests in @m3d are run by
+test.py through the app (m3d --test) and compared with the images in @ref;
+these check properties of the figures we build directly, and are run with
+pytest.
+"""
+
+import types
+
+import pytest
+
+import mathics.builtin.drawing.plot
+mathics.builtin.drawing.plot.use_vectorized_plot = True
+from mathics.session import MathicsSession
+
+import m3d.layout
+
+
+# a minimal front end: all the layout code needs is a session
+@pytest.fixture(scope="session")
+def fe():
+    return types.SimpleNamespace(session=MathicsSession())
+
+
+# figure(expr) evaluates the string expr and returns the plotly Figure it's shown as
+@pytest.fixture
+def figure(fe):
+    def figure(expr):
+        expr = fe.session.evaluate(expr)
+        return m3d.layout.expression_to_layout(fe, expr).object
+    return figure
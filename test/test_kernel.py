@@ -0,0 +1,20 @@
+from m3d import core
+import m3d.kernel
+import m3d.layout
+
+
+def test_evaluate_is_repeatable(fe):
+
+    # the compiled kernel for a Plot3D, whose figure has a box that it rescales
+    target = fe.session.parse("Plot3D[Sin[a x y], {x,-2,2}, {y,-2,2}]")
+    def full(a):
+        expr = target.replace_vars({"Global`a": core.Real(a)}).evaluate(fe.session.evaluation)
+        return m3d.layout.expression_to_layout(fe, expr)
+    kernel = m3d.kernel.compiler(target, ["a"], [1.0], full(1.0))
+    assert kernel is not None
+
+    # the same values give the same figure however many updates came before
+    first = kernel([1.5]).object.to_json()
+    assert kernel([1.5]).object.to_json() == first
+    kernel([0.5])
+    assert kernel([1.5]).object.to_json() == first
@@ -0,0 +1,201 @@
+import base64
+import time
+import types
+
+import cv2
+import numpy as np
+
+import m3d.mesh2d
+import m3d.render
+
+
+# quads over an ny by nx lattice of vertices numbered by rows
+def grid_quads(nx, ny):
+    k = np.arange(nx * ny).reshape(ny, nx)[:-1,:-1].ravel()
+    return np.stack([k, k + 1, k + nx + 1, k + nx], axis=1)
+
+
+# the rgba pixels of an image trace, from its png data uri
+def image_pixels(trace):
+    png = base64.b64decode(trace["source"].split(",", 1)[1])
+    img = cv2.imdecode(np.frombuffer(png, np.uint8), cv2.IMREAD_UNCHANGED)
+    return cv2.cvtColor(img, cv2.COLOR_BGRA2RGBA)
+
+
+# the shapes of each fill trace, split at the nans between them
+def trace_shapes(trace):
+    points = np.stack([trace["x"], trace["y"]], axis=1)
+    shapes = np.split(points, np.flatnonzero(np.isnan(points[:,0])))
+    shapes = [shape[np.isfinite(shape[:,0])] for shape in shapes]
+    return [shape for shape in shapes if len(shape)]
+
+
+def test_same_style_shapes_are_batched(figure):
+    fig = figure("Graphics[Table[Rectangle[{i, 0}, {i + 0.8, 1.5 + Sin[i / 5]}], {i, 0, 199}]]")
+    fills = [t for t in fig.data if t.fill == "toself"]
+    assert len(fills) == 1
+    assert len(trace_shapes(fills[0])) == 200
+
+
+def test_overlapping_disks_batch_quickly():
+
+    builder = m3d.render.FigureBuilder(2, None, None)
+    rng = np.random.default_rng(0)
+    centers = rng.random((3000, 2)) * 10
+    start = time.perf_counter()
+    builder.add_disks(None, [[c, 1.0] for c in centers], None)
+    builder._flush_shapes()
+    elapsed = time.perf_counter() - start
+    assert elapsed < 1, f"{elapsed:.2f} s to batch 3000 overlapping disks"
+
+    # every disk, in drawing order, and none overlapping another in its trace
+    shapes = [trace_shapes(t) for t in builder.data]
+    drawn = np.array([(s.min(axis=0) + s.max(axis=0)) / 2 for ss in shapes for s in ss])
+    assert np.allclose(drawn, centers, atol=1e-3)
+    for ss in shapes:
+        boxes = np.array([[s.min(axis=0), s.max(axis=0)] for s in ss])
+        assert (m3d.render.last_overlapping(boxes) == -1).all()
+
+
+def test_batches_keep_drawing_order():
+
+    # the overlapping-shapes case from test-graphics.m3d
+    builder = m3d.render.FigureBuilder(2, None, None)
+    builder.set_color_rgb((1, 0, 0))
+    builder.add_rectangles(None, [[[0, 0], [2, 2]]], None)
+    builder.set_color_rgb((0, 0, 1))
+    builder.add_disks(None, [[[2, 1], 1]], None)
+    builder.set_color_rgb((1, 0, 0))
+    builder.add_rectangles(None, [[[2.5, 0], [4.5, 2]], [[1, -1], [3, 0.5]]], None)
+    builder._flush_shapes()
+
+    # the later red rectangles overlap the blue disk, and each other,
+    # so neither can join an earlier red batch
+    red, blue = m3d.render.to_color_str((1, 0, 0)), m3d.render.to_color_str((0, 0, 1))
+    assert [t["fillcolor"] for t in builder.data] == [red, blue, red, red]
+    assert [len(trace_shapes(t)) for t in builder.data] == [1, 1, 1, 1]
+
+
+def test_grid_polys_are_a_surface():
+    builder = m3d.render.FigureBuilder(3, None, None)
+    xs, ys = np.linspace(-2, 2, 30), np.linspace(-1, 1, 12)
+    x, y = np.meshgrid(xs, ys)
+    vertices = np.stack([x, y, x + 2 * y**2], axis=-1).reshape(-1, 3)
+    builder.add_polys(vertices, grid_quads(30, 12), None)
+    [surface] = builder.data
+    assert surface["type"] == "surface"
+    assert np.array_equal(surface["x"], xs) and np.array_equal(surface["y"], ys)
+    assert np.array_equal(surface["z"], x + 2 * y**2)
+
+
+def test_plot3d_is_a_surface(figure):
+    fig = figure("Plot3D[x + 2 y^2, {x,-2,2}, {y,-1,1}, PlotPoints->{30,12}, MaxRecursion->0]")
+    assert not [t for t in fig.data if t.type == "mesh3d"]
+    [surface] = [t for t in fig.data if t.type == "surface"]
+    xs, ys, z = (np.asarray(surface[a], dtype=float) for a in "xyz")
+    assert z.shape == (len(ys), len(xs)) and len(xs) > len(ys)
+    x, y = np.meshgrid(xs, ys)
+    assert np.allclose(z, x + 2 * y**2)
+
+
+def test_grid_polys_are_image_pixels():
+    builder = m3d.render.FigureBuilder(2, None, None)
+    xs, ys = np.linspace(0, 3, 40), np.linspace(0, 1, 12)
+    x, y = np.meshgrid(xs, ys)
+    vertices = np.stack([x, y], axis=-1).reshape(-1, 2)
+    colors = np.stack([x / 3, y, np.zeros_like(x), np.ones_like(x)], axis=-1)
+    builder.add_polys(vertices, grid_quads(40, 12), colors.reshape(-1, 4))
+    [image] = builder.data
+    assert image["type"] == "image"
+
+    # one pixel per cell, row j at y0 + j dy, colored with the average of its corners
+    cells = (colors[:-1,:-1] + colors[:-1,1:] + colors[1:,:-1] + colors[1:,1:]) / 4
+    assert np.array_equal(image_pixels(image), np.round(cells * 255).astype(np.uint8))
+    assert np.isclose(image["x0"], xs[0] + (xs[1] - xs[0]) / 2) and np.isclose(image["dx"], xs[1] - xs[0])
+    assert np.isclose(image["y0"], ys[0] + (ys[1] - ys[0]) / 2) and np.isclose(image["dy"], ys[1] - ys[0])
+
+
+def test_densityplot_is_image_pixels(figure):
+    fig = figure(
+        "DensityPlot[y, {x,0,3}, {y,0,1}, PlotPoints->{40,12}, MaxRecursion->0,"
+        " ColorFunction->(GrayLevel[#]&)]"
+    )
+    [image] = [t for t in fig.data if t.type == "image"]
+    gray = image_pixels(image)[...,0].astype(int)
+    ny, nx = gray.shape
+
+    # the pixels cover the plotted domain, and get lighter up the rows but not across
+    assert nx > ny
+    assert np.isclose(image.x0 - image.dx / 2, 0) and np.isclose(image.x0 + (nx - 0.5) * image.dx, 3)
+    assert np.isclose(image.y0 - image.dy / 2, 0) and np.isclose(image.y0 + (ny - 0.5) * image.dy, 1)
+    assert (gray == gray[:,:1]).all()
+    assert (np.diff(gray[:,0]) > 0).all()
+
+
+def test_irregular_mesh_is_rasterized_at_display_size():
+
+    # triangles over a jittered lattice, alternately red and blue vertices
+    rng = np.random.default_rng(0)
+    x, y = np.meshgrid(np.arange(11.0), np.arange(6.0))
+    vertices = np.stack([x + 0.3 * rng.random(x.shape), y + 0.3 * rng.random(y.shape)], axis=-1).reshape(-1, 2)
+    quads = grid_quads(11, 6)
+    tris = np.concatenate([quads[:,[0,1,2]], quads[:,[0,2,3]]])
+    palette = np.array([[1, 0, 0, 1], [0, 0, 1, 1]], dtype=float)
+    colors = palette[np.arange(len(vertices)) % 2]
+    extent = vertices.max(axis=0) - vertices.min(axis=0)
+
+    for width in (300, 600):
+        options = types.SimpleNamespace(image_size=(width, None), plot_range=[None, None])
+        builder = m3d.render.FigureBuilder(2, None, options)
+        builder.add_polys(vertices, tris, colors)
+        [image] = builder.data
+        pixels = image_pixels(image)
+
+        # device pixels for the image size, in the aspect ratio of the mesh
+        ny, nx = pixels.shape[:2]
+        assert nx == width * m3d.mesh2d.device_pixel_ratio
+        assert abs(ny - nx * extent[1] / extent[0]) <= 1
+
+        # filled with the colors of the triangles' first vertices, transparent outside
+        filled = pixels[...,3] == 255
+        assert filled.mean() > 0.8 and (pixels[~filled,3] == 0).all()
+        assert {tuple(p) for p in pixels[filled,:3]} <= {(255, 0, 0), (0, 0, 255)}
+
+
+def test_irregular_mesh_graphics_is_one_image(figure):
+    fig = figure("""Graphics[GraphicsComplex[
+        Flatten[Table[{i + 0.3 Sin[3 j], j + 0.3 Cos[2 i]}, {i,0,10}, {j,0,10}], 1],
+        Polygon[Flatten[Table[
+            {{11 i + j + 1, 11 i + j + 2, 11 (i+1) + j + 1},
+             {11 i + j + 2, 11 (i+1) + j + 2, 11 (i+1) + j + 1}},
+            {i,0,9}, {j,0,9}], 2]],
+        VertexColors -> Flatten[Table[Hue[(i + j) / 25], {i,0,10}, {j,0,10}], 1]
+    ], ImageSize -> 300]""")
+    assert not [t for t in fig.data if t.type == "scatter"]
+    [image] = [t for t in fig.data if t.type == "image"]
+    assert image_pixels(image).shape[1] >= 300
+
+
+def test_images_are_sent_as_png():
+
+    # every pixel different, with some translucent, so any flip, transpose
+    # or channel swap on the way through png shows
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, (7, 13, 4), dtype=np.uint8)
+    img[0,0] = [255, 0, 0, 128]
+    builder = m3d.render.FigureBuilder(2, None, None)
+    builder._add_image(m3d.mesh2d.Raster(img, (0.5, 2.0), (1.0, 0.25)))
+    [image] = builder.data
+    assert "z" not in image and image["source"].startswith("data:image/png;base64,")
+    assert np.array_equal(image_pixels(image), img)
+    assert (image["x0"], image["y0"], image["dx"], image["dy"]) == (0.5, 2.0, 1.0, 0.25)
+
+
+def test_complexplot_is_a_png_image(figure):
+    fig = figure("ComplexPlot[Sin[z], {z, -3 - I, 3 + I}, PlotPoints -> {60, 20}]")
+    [image] = [t for t in fig.data if t.type == "image"]
+    assert image.z is None and image.source.startswith("data:image/png;base64,")
+    ny, nx = image_pixels(image).shape[:2]
+    assert nx > ny
+    assert np.isclose(image.x0 - image.dx / 2, -3) and np.isclose(image.x0 + (nx - 0.5) * image.dx, 3)
+    assert np.isclose(image.y0 - image.dy / 2, -1) and np.isclose(image.y0 + (ny - 0.5) * image.dy, 1)